@@ -0,0 +1,467 @@
+import argparse
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+from psycopg2 import extras
+
+from carrier_recordings import builtin_recordings
+
+# End-to-end benchmark of the tracking pass in lambda_handler. Each size runs in its own
+# process against a synthetic shipments table in a scratch schema of a local Postgres
+# instance, with carrier calls served by a local mock HTTP server replaying recorded
+# UPS/USPS responses. SendGrid is replaced by a recorder so no email is sent.
+#
+#   python benchmark.py --dsn "host=localhost dbname=tracking_bench" --sizes 1000 10000 100000
+#   python benchmark.py --dsn ... --latency-ms 150 --throttle-rate 0.05 --recordings recorded/
+#   python benchmark.py --dsn ... --shards 4 --partition hash
+#   python benchmark.py --dsn ... --startup
+#   python benchmark.py --dsn ... --plans --sizes 1000 10000 100000
+#
+# --recordings points at a directory with ups/*.json and usps/*.json carrier responses;
+# without it a small built-in set covering in-transit, delivered, exception and
+# pre-shipment responses is used.
+
+BENCH_SCHEMA = "tracking_bench"
+
+
+def load_recordings(path):
+    if not path:
+        return builtin_recordings()
+    recordings = {}
+    for carrier in ('UPS', 'USPS'):
+        recordings[carrier] = []
+        for recording_path in sorted(glob.glob(os.path.join(path, carrier.lower(), '*.json'))):
+            with open(recording_path) as f:
+                recordings[carrier].append(json.load(f))
+        if not recordings[carrier]:
+            recordings[carrier] = builtin_recordings()[carrier]
+    return recordings
+
+
+class MockCarrierServer:
+    # Serves the carrier OAuth and tracking endpoints from a separate process, so the mock
+    # doesn't compete with the code under test for the GIL. Responses are picked from the
+    # recordings by a hash of the tracking number, so repeated runs see the same mix.
+    def __init__(self, recordings, latency_ms, throttle_rate):
+        self.recordings = recordings
+        self.latency = latency_ms / 1000
+        self.throttle_rate = throttle_rate
+        self.requests = multiprocessing.Value('i', 0)
+        self.throttled = multiprocessing.Value('i', 0)
+        ThreadingHTTPServer.request_queue_size = 128
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.server.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.process = None
+
+    def handler(self):
+        mock = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, like the real carrier APIs; without TCP_NODELAY the separate header and
+            # body writes hit delayed ACKs and add ~40ms to every response
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def log_message(self, *args):
+                pass
+
+            def respond(self, status, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                self.respond(200, {"access_token": "bench-token", "expires_in": 3600})
+
+            def do_GET(self):
+                throttle = random.random() < mock.throttle_rate
+                with mock.requests.get_lock():
+                    mock.requests.value += 1
+                if throttle:
+                    with mock.throttled.get_lock():
+                        mock.throttled.value += 1
+                time.sleep(mock.latency)
+                if throttle:
+                    self.respond(429, {"error": "rate limited"}, {'Retry-After': '0.1'})
+                    return
+                path = self.path.split('?')[0]
+                carrier = 'USPS' if path.startswith('/tracking/') else 'UPS'
+                tracking_number = path.rstrip('/').rsplit('/', 1)[-1]
+                choices = mock.recordings[carrier]
+                self.respond(200, choices[zlib.crc32(tracking_number.encode()) % len(choices)])
+
+        return Handler
+
+    def start(self):
+        self.process = multiprocessing.Process(target=self.server.serve_forever, daemon=True)
+        self.process.start()
+        self.server.socket.close()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+
+
+def create_schema(cnx, rows, seed, shared_tracking=0.0):
+    # The schema comes from the same migrations the handler applies, in a fresh scratch schema
+    import migrations
+
+    cursor = cnx.cursor()
+    cursor.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE; CREATE SCHEMA {BENCH_SCHEMA}; SET search_path TO {BENCH_SCHEMA};")
+    migrations.migrate(cnx)
+
+    # Generated in the database, so the seed data never counts towards the benchmark process's
+    # memory. A shared order takes the tracking number of the last unshared order before it on
+    # the same carrier, as split shipments and re-ships do.
+    cursor.execute("SELECT setseed(%s);", (((seed * 7919) % 10000) / 10000,))
+    cursor.execute('''
+        INSERT INTO shipments ("OrderNumber", "CustomerName", "CustomerEmail", "TrackingNumber", "CarrierName", "ShippedDate",
+            "StatusCode", "LastLocation", "LastLocationDate", "DaysAtLastLocation", "NotificationSent", "Delayed", "Delivered")
+        SELECT
+            'BENCH' || lpad(n::text, 7, '0'), 'Customer ' || n, 'customer' || n || '@example.com',
+            CASE WHEN n %% 2 = 1 THEN '1Z' || lpad(base::text, 16, '0') ELSE '9400' || lpad(base::text, 18, '0') END,
+            CASE WHEN n %% 2 = 1 THEN 'UPS' ELSE 'USPS' END,
+            shipped, status, location, CASE WHEN location IS NOT NULL THEN shipped END, 0, 'No', 'No', 'No'
+        FROM (
+            SELECT *, max(n) FILTER (WHERE NOT shared) OVER (PARTITION BY n %% 2 ORDER BY n) AS base
+            FROM (
+                SELECT
+                    n,
+                    n >= 2 AND random() < %s AS shared,
+                    %s::date - (1 + floor(random() * 12))::integer AS shipped,
+                    (ARRAY['Pre-Shipment', 'In Transit', '005: On the Way', '003: Shipment Ready for UPS'])[1 + floor(random() * 4)::integer] AS status,
+                    (ARRAY[NULL, 'RENO', 'MEMPHIS', 'DALLAS'])[1 + floor(random() * 4)::integer] AS location
+                FROM generate_series(0, %s - 1) AS n
+                ORDER BY n
+            ) generated
+        ) numbered;
+    ''', (shared_tracking, datetime.date.today(), rows))
+
+
+def hot_queries(rows):
+    # The statements each run issues against tables that grow with the order volume, shaped
+    # as in shipment_store, checkpoints and event_history, with parameters for a table of rows
+    import shipment_store
+
+    middle = f"BENCH{rows // 2:07d}"
+    return [
+        ("tracking number lookup", shipment_store.scan_query('WHERE s."TrackingNumber" = ANY(%s)'), (["1Z0000000000000001", f"9400{rows // 2:018d}"],)),
+        ("resumed scan", shipment_store.scan_query('WHERE s."OrderNumber" > %s ORDER BY s."OrderNumber" LIMIT %s'), (middle, 1000)),
+        ("hash shard page", shipment_store.scan_query(
+            'WHERE abs(hashtext(s."OrderNumber")::bigint) %% %s = %s AND s."OrderNumber" > %s ORDER BY s."OrderNumber" LIMIT %s FOR UPDATE OF s SKIP LOCKED'
+        ), (4, 1, middle, 500)),
+        ("carrier shard page", shipment_store.scan_query(
+            'WHERE s."CarrierName" = ANY(%s) AND s."OrderNumber" > %s ORDER BY s."OrderNumber" LIMIT %s FOR UPDATE OF s SKIP LOCKED'
+        ), (['UPS'], middle, 500)),
+        ("unfinished checkpoint", 'SELECT "RunId" FROM run_checkpoints WHERE NOT "Completed" AND "ParentRunId" IS NULL AND "StartedAt" > %s ORDER BY "StartedAt" DESC LIMIT 1;',
+            (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=12),)),
+        ("shard checkpoints", 'SELECT "Aggregates" FROM run_checkpoints WHERE "ParentRunId" = %s AND "Completed";', ("run0",)),
+        ("delivered past retention", 'SELECT "OrderNumber" FROM delivered WHERE "ShippedDate" < %s LIMIT %s;', (datetime.date.today() - datetime.timedelta(days=90), 5000)),
+    ]
+
+
+def plan_scans(plan):
+    # (node type, relation or index) for every scan node of an EXPLAIN (FORMAT JSON) plan
+    scans = []
+    if 'Scan' in plan['Node Type']:
+        scans.append((plan['Node Type'], plan.get('Index Name') or plan.get('Relation Name')))
+    for child in plan.get('Plans', []):
+        scans.extend(plan_scans(child))
+    return scans
+
+
+def fill_history_tables(cursor, rows):
+    # Poll state, delivered orders and finished checkpoints in proportion to the shipments, so
+    # every hot query runs against tables of realistic size
+    cursor.execute('''
+        INSERT INTO shipment_poll_state ("OrderNumber", "LastPolled", "UnchangedPolls")
+        SELECT "OrderNumber", now(), 0 FROM shipments;
+        INSERT INTO delivered SELECT * FROM shipments;
+        UPDATE delivered SET "OrderNumber" = 'D' || "OrderNumber", "Delivered" = 'Yes';
+    ''')
+    cursor.execute('''
+        INSERT INTO run_checkpoints ("RunId", "ParentRunId", "StartedAt", "UpdatedAt", "Completed")
+        SELECT 'run' || n, CASE WHEN n %% 5 = 0 THEN NULL ELSE 'run' || (n / 5) END, now() - n * interval '1 hour', now(), true
+        FROM generate_series(1, %s) AS n;
+    ''', (max(rows // 10, 10),))
+    cursor.execute("ANALYZE;")
+
+
+def plan_check(args):
+    # EXPLAIN each hot query at each table size. Small tables are legitimately read with a
+    # sequential scan; from --plan-min-rows up, a query that stops using an index fails the check.
+    print(f"{'rows':>8}  {'query':<26} {'scans'}")
+    regressions = 0
+    for size in args.sizes:
+        setup = psycopg2.connect(args.dsn)
+        create_schema(setup, size, args.seed)
+        cursor = setup.cursor()
+        fill_history_tables(cursor, size)
+        for name, query, params in hot_queries(size):
+            cursor.execute(f"EXPLAIN (FORMAT JSON) {query}", params)
+            plan = cursor.fetchone()[0][0]['Plan']
+            scans = plan_scans(plan)
+            sequential = [relation for node_type, relation in scans if node_type == 'Seq Scan']
+            failed = bool(sequential) and size >= args.plan_min_rows
+            regressions += failed
+            described = ", ".join(f"{node_type} on {relation}" for node_type, relation in scans)
+            print(f"{size:>8}  {name:<26} {described}{'  <-- sequential scan' if failed else ''}")
+        setup.rollback()
+        setup.close()
+    print(f"{regressions} hot quer{'y' if regressions == 1 else 'ies'} without an index scan")
+    return regressions
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def reset_schema(args, rows):
+    setup = psycopg2.connect(args.dsn)
+    create_schema(setup, rows, args.seed, args.shared_tracking)
+    setup.commit()
+    setup.close()
+
+
+def prepare(args, rows):
+    # Builds the scratch schema, starts the mock carrier server and points the handler at both.
+    # Returns the mock, the per-call tracking latencies and the sizes of the emails "sent".
+    import carriers
+    import sharding
+    import tracking_notifier
+
+    random.seed(args.seed)
+    mock = MockCarrierServer(load_recordings(args.recordings), args.latency_ms, args.throttle_rate)
+    mock.start()
+    reset_schema(args, rows)
+
+    # Point the carrier layer at the mock server
+    carriers.USPS_OAUTH_URL = f"{mock.url}/oauth2/v3/token"
+    carriers.UPS_OAUTH_URL = f"{mock.url}/security/v1/oauth/token"
+    carriers.USPS_TRACKING_URL = f"{mock.url}/tracking/v3/tracking/{{}}"
+    carriers.UPS_TRACKING_URL = f"{mock.url}/api/track/v1/details/{{}}"
+    carriers.token_manager.tokens.clear()
+    carriers.response_cache.clear()
+    carriers.backoff_base = 0.05
+    for client in carriers.clients.values():
+        client.bucket.rate = client.bucket.capacity = client.bucket.tokens = args.rate
+
+    latencies = []
+    latency_lock = threading.Lock()
+
+    def timed(track):
+        def wrapper(*track_args):
+            started = time.perf_counter()
+            try:
+                return track(*track_args)
+            finally:
+                with latency_lock:
+                    latencies.append(time.perf_counter() - started)
+        return wrapper
+
+    for adapter in carriers.adapters.values():
+        adapter.track = timed(adapter.track)
+
+    # Sharded runs fan out to forked worker processes, which inherit the patches above
+    sharding.shard_count = args.shards
+    sharding.shard_partition = args.partition
+    sharding.shard_invoker = 'local'
+
+    sent_reports = []
+
+    class RecordingSendGrid:
+        def send(self, message):
+            sent_reports.append(len(str(message.get())))
+
+    def bench_connect(**kwargs):
+        return psycopg2.connect(args.dsn, options=f"-c search_path={BENCH_SCHEMA}")
+
+    tracking_notifier.sendgrid_client = RecordingSendGrid
+    tracking_notifier.connect = bench_connect
+    return mock, latencies, sent_reports
+
+
+def run_once(args):
+    # Runs one benchmark size in this process and prints a JSON result line
+    import tracking_notifier
+    from instrumentation import metrics
+
+    mock, latencies, sent_reports = prepare(args, args.rows)
+
+    # ru_maxrss is a lifetime peak, so the handler's own share is how far it raises the peak
+    # reached by imports and setup
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    tracking_notifier.lambda_handler({}, None)
+    elapsed = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    mock.stop()
+
+    # With --shards the tracking work happens in worker processes, so latencies, round-trips and
+    # memory only cover this process; rows/s and the mock's request counts cover the whole run
+    result = {
+        'rows': args.rows,
+        'seconds': round(elapsed, 3),
+        'rows_per_sec': round(args.rows / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'carrier_requests': mock.requests.value,
+        'throttled': mock.throttled.value,
+        'db_round_trips': metrics.counters.get('db_round_trips', 0),
+        'peak_rss_mb': round(rss_after / 1024, 1),
+        'handler_rss_mb': round((rss_after - rss_before) / 1024, 1),
+        'report_bytes': sum(sent_reports),
+    }
+    print(json.dumps(result))
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def measure_imports(repeats):
+    # Import cost of the handler module in fresh interpreters, from -X importtime
+    totals = []
+    heaviest = {}
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import tracking_notifier'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        # A module's own imports are listed just before it, one level deeper
+        children = []
+        for line in output.stderr.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            _, cumulative, name = line[len('import time:'):].split('|')
+            depth = (len(name) - len(name.lstrip()) - 1) // 2
+            if depth == 1:
+                children.append((name.strip(), int(cumulative)))
+            elif depth == 0:
+                if name.strip() == 'tracking_notifier':
+                    totals.append(int(cumulative))
+                    for child, cumulative in children:
+                        heaviest.setdefault(child, []).append(cumulative)
+                children = []
+    top = sorted(((median(times), name) for name, times in heaviest.items()), reverse=True)[:5]
+    return median(totals) / 1000, [(name, round(us / 1000, 1)) for us, name in top]
+
+
+def run_startup(args):
+    # Cold and warm invocation of the handler in a fresh process, on a small table so the
+    # fixed per-invocation cost dominates; prints a JSON result line
+    started = time.perf_counter()
+    import tracking_notifier
+    import_seconds = time.perf_counter() - started
+    import carriers
+
+    mock, latencies, sent_reports = prepare(args, args.startup_rows)
+    timings = []
+    for run in range(3):
+        # Same rows every time, so warm runs do the same work as the first
+        if run:
+            reset_schema(args, args.startup_rows)
+            carriers.response_cache.clear()
+        started = time.perf_counter()
+        tracking_notifier.lambda_handler({}, None)
+        timings.append(time.perf_counter() - started)
+    mock.stop()
+    print(json.dumps({
+        'startup': True,
+        'import_ms': round(import_seconds * 1000, 1),
+        'cold_invocation_ms': round(timings[0] * 1000, 1),
+        'warm_invocation_ms': round(median(timings[1:]) * 1000, 1),
+    }))
+
+
+def startup_report(args):
+    import_ms, heaviest = measure_imports(args.startup_repeats)
+    print(f"import tracking_notifier (fresh interpreter, median of {args.startup_repeats}): {import_ms:.1f} ms")
+    for name, ms in heaviest:
+        print(f"    {name:<24} {ms:>7.1f} ms")
+
+    command = [
+        sys.executable, os.path.abspath(__file__), '--startup-child', '--dsn', args.dsn, '--startup-rows', str(args.startup_rows),
+        '--latency-ms', str(args.latency_ms), '--seed', str(args.seed)
+    ]
+    output = subprocess.run(command, capture_output=True, text=True)
+    result_lines = [line for line in output.stdout.splitlines() if line.startswith('{"startup"')]
+    if output.returncode != 0 or not result_lines:
+        print(f"startup run failed:\n{output.stderr[-2000:]}")
+        return
+    r = json.loads(result_lines[-1])
+    print(f"first invocation ({args.startup_rows} rows): {r['cold_invocation_ms']} ms; warm invocation: {r['warm_invocation_ms']} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dsn', required=True, help="libpq connection string for a scratch database; the benchmark owns the tracking_bench schema in it")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--rows', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--latency-ms', type=float, default=50)
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help="Fraction of tracking requests answered with 429")
+    parser.add_argument('--rate', type=float, default=1000, help="Per-carrier request rate limit used for the run")
+    parser.add_argument('--recordings')
+    parser.add_argument('--shared-tracking', type=float, default=0.0, help="Fraction of orders sharing a tracking number with an earlier order")
+    parser.add_argument('--shards', type=int, default=1, help="Worker processes for a sharded run; 1 runs the pass in a single process")
+    parser.add_argument('--partition', choices=['hash', 'carrier'], default='hash')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--startup', action='store_true', help="Measure import time and cold versus warm invocation instead of throughput")
+    parser.add_argument('--startup-rows', type=int, default=20)
+    parser.add_argument('--startup-repeats', type=int, default=7)
+    parser.add_argument('--startup-child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--plans', action='store_true', help="Check that the hot queries use index scans at each of --sizes instead of measuring throughput")
+    parser.add_argument('--plan-min-rows', type=int, default=10000, help="Smallest table size at which a sequential scan fails the plan check")
+    args = parser.parse_args()
+
+    if args.startup_child:
+        run_startup(args)
+        return
+    if args.startup:
+        startup_report(args)
+        return
+    if args.plans:
+        sys.exit(1 if plan_check(args) else 0)
+    if args.rows:
+        run_once(args)
+        return
+
+    print(f"{'rows':>8} {'seconds':>9} {'rows/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'requests':>9} {'429s':>6} {'db trips':>9} {'peak MB':>8} {'+MB':>6}")
+    for size in args.sizes:
+        # A fresh process per size keeps peak RSS and module state independent between runs
+        command = [
+            sys.executable, os.path.abspath(__file__), '--rows', str(size), '--dsn', args.dsn,
+            '--latency-ms', str(args.latency_ms), '--throttle-rate', str(args.throttle_rate),
+            '--rate', str(args.rate), '--seed', str(args.seed), '--shards', str(args.shards), '--partition', args.partition,
+            '--shared-tracking', str(args.shared_tracking)
+        ] + (['--recordings', args.recordings] if args.recordings else [])
+        output = subprocess.run(command, capture_output=True, text=True)
+        result_lines = [line for line in output.stdout.splitlines() if line.startswith('{"rows"')]
+        if output.returncode != 0 or not result_lines:
+            print(f"{size:>8} failed:\n{output.stderr[-2000:]}")
+            continue
+        r = json.loads(result_lines[-1])
+        print(f"{r['rows']:>8} {r['seconds']:>9} {r['rows_per_sec']:>9} {r['p50_ms']:>8} {r['p99_ms']:>8} {r['carrier_requests']:>9} {r['throttled']:>6} {r['db_round_trips']:>9} {r['peak_rss_mb']:>8} {r['handler_rss_mb']:>6}")
+
+
+if __name__ == '__main__':
+    main()
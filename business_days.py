@@ -0,0 +1,112 @@
+import datetime
+from array import array
+
+import config
+
+
+def nth_weekday(year, month, weekday, n):
+    # n-th given weekday of the month (Monday is 0); n=-1 means the last one
+    if n > 0:
+        first = datetime.date(year, month, 1)
+        return first + datetime.timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    next_month = datetime.date(year + month // 12, month % 12 + 1, 1)
+    last = next_month - datetime.timedelta(days=1)
+    return last - datetime.timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def observed(day):
+    # Holidays falling on a weekend are observed on the nearest weekday
+    if day.weekday() == 5:
+        return day - datetime.timedelta(days=1)
+    if day.weekday() == 6:
+        return day + datetime.timedelta(days=1)
+    return day
+
+
+def us_federal_holidays(year):
+    return {
+        observed(datetime.date(year, 1, 1)),
+        nth_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        nth_weekday(year, 2, 0, 3),  # Washington's Birthday
+        nth_weekday(year, 5, 0, -1),  # Memorial Day
+        observed(datetime.date(year, 6, 19)),
+        observed(datetime.date(year, 7, 4)),
+        nth_weekday(year, 9, 0, 1),  # Labor Day
+        nth_weekday(year, 10, 0, 2),  # Columbus Day
+        observed(datetime.date(year, 11, 11)),
+        nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        observed(datetime.date(year, 12, 25)),
+    }
+
+
+# Explicitly configured holidays take precedence for the years they cover; other years fall
+# back to the computed federal calendar
+configured_holidays = set(getattr(config, 'us_holidays', None) or config.us_holidays_2023.keys())
+
+
+def default_holidays(year):
+    configured = {day for day in configured_holidays if day.year == year}
+    return configured or us_federal_holidays(year)
+
+
+class BusinessCalendar:
+    # Prefix-sum table of business days: cumulative[i] is the number of business days in
+    # [origin, origin + i days), so counting business days between two dates is two lookups.
+    # The table grows a whole year at a time when a date outside it is requested.
+    def __init__(self, holidays=default_holidays, first_year=None, last_year=None):
+        today = datetime.date.today()
+        self.holidays = holidays
+        self.first_year = first_year or today.year - 2
+        self.last_year = last_year or today.year + 1
+        self.build()
+
+    def build(self):
+        self.origin = datetime.date(self.first_year, 1, 1)
+        holidays = set()
+        for year in range(self.first_year, self.last_year + 1):
+            holidays |= set(self.holidays(year))
+
+        day = self.origin
+        end = datetime.date(self.last_year, 12, 31)
+        step = datetime.timedelta(days=1)
+        count = 0
+        self.cumulative = array('I', [0])
+        while day <= end:
+            if day.weekday() < 5 and day not in holidays:
+                count += 1
+            self.cumulative.append(count)
+            day += step
+
+    def cover(self, *days):
+        first_year = min(self.first_year, *[day.year for day in days])
+        last_year = max(self.last_year, *[day.year for day in days])
+        if (first_year, last_year) != (self.first_year, self.last_year):
+            self.first_year, self.last_year = first_year, last_year
+            self.build()
+
+    def index(self, day):
+        return (day - self.origin).days
+
+    def count(self, start, end):
+        # Business days in the inclusive range [start, end]
+        return self.count_many([start], end)[0]
+
+    def count_many(self, starts, end):
+        # Business days from each start date to a shared end date, with the end looked up once
+        starts = [to_date(start) for start in starts]
+        end = to_date(end)
+        self.cover(end, *starts)
+        end_total = self.cumulative[self.index(end) + 1]
+        return [end_total - self.cumulative[self.index(start)] if start <= end else 0 for start in starts]
+
+
+def to_date(value):
+    # Accepts dates, datetimes and the carriers' YYYYMMDD strings
+    if isinstance(value, str):
+        return datetime.datetime.strptime(value, "%Y%m%d").date()
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    return value
+
+
+calendar = BusinessCalendar()
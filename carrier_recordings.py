@@ -0,0 +1,44 @@
+import datetime
+
+
+# A small set of recorded-style UPS and USPS tracking responses covering in-transit, delivered,
+# exception and pre-shipment shipments. Served by the benchmark's mock carrier server and
+# replayed through classify() by test_classification.py.
+
+
+def builtin_recordings(today=None):
+    today = today or datetime.date.today()
+    activity_date = (today - datetime.timedelta(days=1)).strftime("%Y%m%d")
+    delivery_date = (today + datetime.timedelta(days=3)).strftime("%Y%m%d")
+
+    def ups(code, description, city, delivery_dates):
+        return {
+            "trackResponse": {"shipment": [{"package": [{
+                "currentStatus": {"code": code, "description": description},
+                "activity": [{"date": activity_date, "time": "101500", "location": {"address": {"city": city}}}],
+                "deliveryDate": delivery_dates,
+            }]}]}
+        }
+
+    def usps(category, status, city):
+        return {
+            "statusCategory": category,
+            "status": status,
+            "trackingEvents": [{"eventCity": city, "eventTimestamp": f"{today.isoformat()}T10:15:00"}],
+        }
+
+    return {
+        'UPS': [
+            ups("005", "On the Way", "LOUISVILLE", [{"type": "SDD", "date": delivery_date}]),
+            ups("005", "On the Way", "RENO", []),
+            ups("011", "Delivered", "AUSTIN", []),
+            ups("003", "Shipment Ready for UPS", "DALLAS", []),
+            ups("X", "Exception", "DENVER", []),
+        ],
+        'USPS': [
+            usps("In Transit", "In Transit to Next Facility", "MEMPHIS"),
+            usps("Delivered", "Delivered, In/At Mailbox", "AUSTIN"),
+            usps("Pre-Shipment", "Shipping Label Created", "DALLAS"),
+            usps("Alert", "Delivery Attempted - No Access to Delivery Location", "DENVER"),
+        ],
+    }
@@ -0,0 +1,597 @@
+import hmac
+import json
+import os
+import random
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from email.utils import parsedate_to_datetime
+
+import config
+from instrumentation import debug, metrics
+from tracking_status import MalformedResponse, NoTrackingData, ResponseError, TrackingStatus, loads, parse, parse_or_error
+
+
+USPS_OAUTH_URL = "https://api.usps.com/oauth2/v3/token"
+UPS_OAUTH_URL = "https://onlinetools.ups.com/security/v1/oauth/token"
+USPS_TRACKING_URL = "https://api.usps.com/tracking/v3/tracking/{}"
+UPS_TRACKING_URL = "https://onlinetools.ups.com/api/track/v1/details/{}"
+
+# Maximum number of in-flight tracking requests per carrier
+carrier_concurrency = getattr(config, 'carrier_concurrency', {'USPS': 8, 'UPS': 8})
+request_timeout = getattr(config, 'request_timeout', 30)
+
+# Multi-number USPS tracking endpoint (POST, JSON list of tracking numbers) and how many numbers
+# to send per request. Leave the URL unset to track USPS shipments one number at a time.
+usps_batch_tracking_url = getattr(config, 'usps_batch_tracking_url', None)
+usps_batch_size = getattr(config, 'usps_batch_size', 35)
+
+# Sustained requests per second allowed by each carrier
+carrier_rate_limits = getattr(config, 'carrier_rate_limits', {'USPS': 10, 'UPS': 10})
+
+# Retry settings for throttled (429), unavailable (5xx) and dropped requests
+max_retries = getattr(config, 'max_retries', 4)
+backoff_base = getattr(config, 'backoff_base', 0.5)
+backoff_cap = getattr(config, 'backoff_cap', 30)
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Tracking responses are reused for this many seconds by any pass in the same warm container;
+# 0 disables the cache
+response_cache_ttl = getattr(config, 'response_cache_ttl', 120)
+response_cache_size = getattr(config, 'response_cache_size', 10000)
+
+# Pushed tracking events are only applied when the request's credential header matches this
+# value, which is also the credential set on the UPS Track Alert subscription. Unset, pushed
+# events are rejected.
+tracking_webhook_credential = getattr(config, 'tracking_webhook_credential', None)
+WEBHOOK_CREDENTIAL_HEADER = 'credential'
+
+# Tokens are refreshed this many seconds before they expire; carriers that omit expires_in
+# are assumed to issue tokens valid for default_token_lifetime seconds
+token_refresh_margin = getattr(config, 'token_refresh_margin', 300)
+default_token_lifetime = getattr(config, 'default_token_lifetime', 3600)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        # Drain the bucket so every worker sharing it backs off, not just the throttled one
+        with self.lock:
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class ResponseCache:
+    # Least-recently-used cache of tracking responses keyed by (carrier, tracking number),
+    # with entries expiring ttl seconds after they were stored
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (expires at, TrackingStatus)
+        self.lock = threading.Lock()
+
+    def get(self, carrier_name, tracking_number):
+        key = (carrier_name, tracking_number)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires_at, status = entry
+            if time.monotonic() >= expires_at:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return status
+
+    def put(self, carrier_name, tracking_number, status):
+        if self.ttl <= 0 or self.max_entries <= 0:
+            return
+        key = (carrier_name, tracking_number)
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, status)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+response_cache = ResponseCache(response_cache_ttl, response_cache_size)
+
+
+def retry_after_seconds(response):
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, retry_at.timestamp() - time.time())
+
+
+class CarrierClient:
+    def __init__(self, name, rate, pool_size):
+        self.name = name
+        self.pool_size = pool_size
+        self.bucket = TokenBucket(rate)
+        self.session = None
+        self.session_lock = threading.Lock()
+
+    def new_session(self):
+        # requests is only imported once a carrier is actually called, which ingestion and
+        # pushed-event invocations never do
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        # One persistent session per carrier host so connections are kept alive and reused
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+        return session
+
+    def get_session(self):
+        with self.session_lock:
+            if self.session is None:
+                self.session = self.new_session()
+            return self.session
+
+    def backoff(self, attempt):
+        # Full jitter exponential backoff
+        return random.uniform(0, min(backoff_cap, backoff_base * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        import requests
+
+        session = self.get_session()
+        kwargs.setdefault('timeout', request_timeout)
+        for attempt in range(max_retries + 1):
+            self.bucket.acquire()
+            if attempt:
+                metrics.incr('carrier_retries')
+            metrics.incr('carrier_requests')
+            try:
+                with metrics.timer('carrier_request'):
+                    response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == max_retries:
+                    raise
+                delay = self.backoff(attempt)
+                print(f"{self.name} request failed ({e}); retrying in {delay:.1f}s")
+            else:
+                metrics.incr('carrier_response_bytes', len(response.content))
+                if response.status_code not in RETRY_STATUSES or attempt == max_retries:
+                    return response
+                delay = retry_after_seconds(response)
+                if delay is None:
+                    delay = self.backoff(attempt)
+                debug(f"{self.name} returned {response.status_code}; retrying in {delay:.1f}s")
+                if response.status_code == 429:
+                    metrics.incr('carrier_throttled')
+                    # The next acquire() waits out the pause for this worker too
+                    self.bucket.pause(delay)
+                    continue
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+clients = {
+    carrier: CarrierClient(carrier, carrier_rate_limits.get(carrier, 10), carrier_concurrency.get(carrier, 4))
+    for carrier in ('USPS', 'UPS')
+}
+
+
+def reset_sessions():
+    # A forked process must not share its parent's kept-alive connections
+    for client in clients.values():
+        client.session = None
+
+
+class AuthenticationError(Exception):
+    # A carrier's OAuth endpoint didn't issue a token
+    pass
+
+
+def get_ups_token():
+    payload = {
+        "grant_type": "client_credentials"
+    }
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    response = clients['UPS'].post(UPS_OAUTH_URL, data=payload, headers=headers, auth=(config.UPS_CLIENT_ID, config.UPS_CLIENT_SECRET))
+    if response.status_code != 200:
+        print("Error occurred: ", response.text)  # Print the error message
+        response.raise_for_status()  # This will raise an exception if the request failed
+    data = response.json()
+    return str(data["access_token"]), int(data.get("expires_in", default_token_lifetime))
+
+
+def get_usps_access_token():
+    headers = {
+        'Content-Type': 'application/json',
+    }
+    data = {
+        'client_id': config.USPS_CLIENT_ID,
+        'client_secret': config.USPS_CLIENT_SECRET,
+        'grant_type': 'client_credentials',
+        'customer_registration_id': config.USPS_CUSTOMER_REGISTRATION_ID,
+        "mailer_id": config.USPS_MAILER_ID,
+    }
+
+    response = clients['USPS'].post(USPS_OAUTH_URL, headers=headers, json=data)
+
+    if response.status_code == 200:
+        response_json = response.json()
+        return response_json['access_token'], int(response_json.get('expires_in', default_token_lifetime))
+    else:
+        print(f"Request failed with status code: {response.status_code}")
+        raise AuthenticationError(f"USPS token request failed with status code {response.status_code}")
+
+
+class TokenManager:
+    def __init__(self, fetchers, cache_path=None):
+        self.fetchers = fetchers
+        self.cache_path = cache_path
+        self.tokens = {}  # carrier -> (access_token, expires_at)
+        self.failures = {}  # carrier -> AuthenticationError from this invocation's failed token fetch
+        self.locks = {carrier: threading.Lock() for carrier in fetchers}
+        self.load()
+
+    def load(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return
+        try:
+            with open(self.cache_path) as f:
+                cached = json.load(f)
+            for carrier, entry in cached.items():
+                if carrier in self.fetchers:
+                    self.tokens[carrier] = (entry['access_token'], entry['expires_at'])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"Ignoring unreadable token cache {self.cache_path}: {e}")
+
+    def save(self):
+        if not self.cache_path:
+            return
+        cached = {carrier: {'access_token': token, 'expires_at': expires_at} for carrier, (token, expires_at) in self.tokens.items()}
+        tmp_path = f"{self.cache_path}.tmp"
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            print(f"Could not write token cache {self.cache_path}: {e}")
+
+    def get(self, carrier):
+        # Holding the per-carrier lock while refreshing means concurrent workers wait for one
+        # refresh instead of all re-authenticating at once. A failed fetch is remembered until
+        # clear_failures(), so the rest of the pass fails fast instead of retrying OAuth per row.
+        with self.locks[carrier]:
+            token, expires_at = self.tokens.get(carrier, (None, 0))
+            if token and time.time() < expires_at - token_refresh_margin:
+                return token
+            if carrier in self.failures:
+                raise self.failures[carrier]
+            try:
+                with metrics.timer('token_fetch'):
+                    token, expires_in = self.fetchers[carrier]()
+                if not token:
+                    raise AuthenticationError(f"{carrier} token response had no access token")
+            except Exception as e:
+                error = e if isinstance(e, AuthenticationError) else AuthenticationError(f"{carrier} token request failed: {e}")
+                print(f"Could not authenticate with {carrier}; failing its shipments for this invocation: {error}")
+                self.failures[carrier] = error
+                raise error from None
+            self.tokens[carrier] = (token, time.time() + expires_in)
+            self.save()
+            return token
+
+    def clear_failures(self):
+        # Called at the start of each invocation so a warm container tries again
+        self.failures.clear()
+
+    def invalidate(self, carrier, token):
+        # Only drop the token if it hasn't already been replaced by another worker
+        with self.locks[carrier]:
+            if self.tokens.get(carrier, (None, 0))[0] == token:
+                del self.tokens[carrier]
+
+
+token_manager = TokenManager(
+    {'USPS': get_usps_access_token, 'UPS': get_ups_token},
+    getattr(config, 'token_cache_path', None)
+)
+
+
+def authorized_request(carrier, method, url, headers, **kwargs):
+    # Send a tracking request with the cached token, refreshing it once if the carrier rejects it
+    for attempt in range(2):
+        token = token_manager.get(carrier)
+        response = clients[carrier].request(method, url, headers={**headers, 'Authorization': 'Bearer ' + token}, **kwargs)
+        if response.status_code != 401:
+            break
+        token_manager.invalidate(carrier, token)
+    return response
+
+
+def check_status(carrier_name, response):
+    # Only a 200 carries tracking data; an error body must not be read as "no tracking yet".
+    # The exception is a not-found 404, which UPS answers for labels it hasn't scanned yet.
+    if response.status_code == 404 and 'not found' in response.text.lower():
+        raise NoTrackingData(f"{carrier_name} has no tracking information yet: {response.text[:200]}")
+    if response.status_code != 200:
+        response.raise_for_status()
+        raise MalformedResponse(f"{carrier_name} tracking request returned HTTP {response.status_code}")
+
+
+def parse_json(response):
+    with metrics.timer('json_parse'):
+        return loads(response.content)
+
+
+class CarrierAdapter(ABC):
+    # track() returns one parsed tracking response as a TrackingStatus, raising a
+    # tracking_status.ResponseError if the response can't be used. Adapters whose carrier
+    # accepts several numbers per request also define track_many() and set batch_size above 1;
+    # it returns {tracking number: TrackingStatus or ResponseError} for the numbers it found.
+    batch_size = 1
+
+    @abstractmethod
+    def track(self, tracking_number):
+        pass
+
+
+class USPSAdapter(CarrierAdapter):
+    def __init__(self, batch_url=None, batch_size=1):
+        self.batch_url = batch_url
+        if batch_url:
+            self.batch_size = batch_size
+
+    def track(self, tracking_number):
+        url = USPS_TRACKING_URL.format(tracking_number)
+        response = authorized_request('USPS', 'GET', url, headers={}, params={'expand': 'DETAIL'})
+        check_status('USPS', response)
+        return parse('USPS', parse_json(response))
+
+    def track_many(self, tracking_numbers):
+        response = authorized_request(
+            'USPS',
+            'POST',
+            self.batch_url,
+            headers={'Content-Type': 'application/json'},
+            params={'expand': 'DETAIL'},
+            json=[{'trackingNumber': tracking_number} for tracking_number in tracking_numbers]
+        )
+        check_status('USPS', response)
+        # Each element has the same shape as a single-number response
+        return {item['trackingNumber']: parse_or_error('USPS', item) for item in parse_json(response) if item.get('trackingNumber')}
+
+
+class UPSAdapter(CarrierAdapter):
+    # The UPS Track API only takes one inquiry number per request
+    def track(self, tracking_number):
+        response = authorized_request(
+            'UPS',
+            'GET',
+            UPS_TRACKING_URL.format(tracking_number),
+            headers={
+                "Content-Type": "application/json",
+                "transId": config.trans_id,
+                "transactionSrc": config.transaction_src,
+            },
+            params={
+                "locale": "en_US",
+                "returnSignature": "false"
+            }
+        )
+        check_status('UPS', response)
+        return parse('UPS', parse_json(response))
+
+
+def webhook_authorized(headers):
+    # API Gateway may pass header names in any case
+    if not tracking_webhook_credential:
+        return False
+    supplied = {name.lower(): value for name, value in (headers or {}).items()}.get(WEBHOOK_CREDENTIAL_HEADER)
+    return supplied is not None and hmac.compare_digest(str(supplied).encode(), str(tracking_webhook_credential).encode())
+
+
+def is_ups_track_alert(payload):
+    return isinstance(payload, dict) and 'trackingNumber' in payload and 'activityStatus' in payload
+
+
+def ups_track_alert_status(alert):
+    # A UPS Track Alert webhook payload carries the same fields as the latest Track API activity
+    status = alert['activityStatus']
+    activity_date = alert.get('localActivityDate')
+    return TrackingStatus(
+        carrier='UPS',
+        code=status.get('code'),
+        description=status.get('description'),
+        category=status.get('type'),
+        city=(alert.get('activityLocation') or {}).get('city'),
+        activity_date=activity_date,
+        event_time=f"{activity_date or ''}{alert.get('localActivityTime') or ''}" or None,
+        delivery_date=alert.get('scheduledDeliveryDate'),
+    )
+
+
+def normalize_tracking_events(payload):
+    # Pushed events arrive either as a single UPS Track Alert payload or as
+    # {"tracking_events": [...]}, where each element is a UPS Track Alert payload or a generic
+    # {"carrier": ..., "tracking_number": ..., "details": <tracking API response>} event.
+    # Returns (carrier, tracking number, TrackingStatus) tuples; unrecognised events and
+    # responses that can't be parsed are skipped.
+    events = [payload] if is_ups_track_alert(payload) else payload.get('tracking_events') or []
+    normalized = []
+    for event in events:
+        if is_ups_track_alert(event):
+            normalized.append(('UPS', event['trackingNumber'], ups_track_alert_status(event)))
+        elif isinstance(event, dict) and event.get('carrier') in adapters and event.get('tracking_number') and isinstance(event.get('details'), dict):
+            try:
+                status = parse(event['carrier'], event['details'])
+            except ResponseError as e:
+                print(f"Skipping tracking event for {event['tracking_number']}: {e}")
+                continue
+            normalized.append((event['carrier'], event['tracking_number'], status))
+            # A full tracking response, so a scheduled pass in this container can reuse it. Track
+            # Alert payloads only carry the latest activity and aren't cached.
+            response_cache.put(event['carrier'], event['tracking_number'], status)
+        else:
+            print(f"Skipping unrecognised tracking event: {str(event)[:200]}")
+    return normalized
+
+
+adapters = {
+    'USPS': USPSAdapter(usps_batch_tracking_url, usps_batch_size),
+    'UPS': UPSAdapter(),
+}
+
+# Maximum number of shipments submitted for tracking whose results haven't been consumed yet,
+# so a streamed shipment scan is never read far ahead of the carriers
+fetch_window = getattr(config, 'fetch_window', 2 * sum(carrier_concurrency.get(carrier, 4) * adapter.batch_size for carrier, adapter in adapters.items()))
+
+
+def fetch_tracking_details(rows):
+    # Fetch tracking details for every row concurrently, with one bounded pool per carrier,
+    # and yield (row, TrackingStatus, error) tuples in completion order so the caller can process
+    # results as they arrive. Rows for carriers we don't track are skipped. Each tracking
+    # number is requested once however many rows share it, and not at all if its response is
+    # still in response_cache. Carriers with a multi-number endpoint get numbers in batches; a
+    # batch request that fails as a whole is retried one number at a time, unless it failed
+    # because the carrier wouldn't issue a token, in which case every row for that carrier gets
+    # the AuthenticationError without another request.
+    executors = {
+        carrier: ThreadPoolExecutor(max_workers=carrier_concurrency.get(carrier, 4), thread_name_prefix=f"{carrier}-tracking")
+        for carrier in adapters
+    }
+    rows = iter(rows)
+    pending = {}  # future -> (carrier, tracking numbers it covers)
+    waiting = {}  # (carrier, tracking number) -> rows waiting for its response
+    batches = {carrier: [] for carrier in adapters}
+    auth_failures = {}  # carrier -> AuthenticationError
+    in_flight = 0
+    exhausted = False
+
+    def submit(carrier_name, tracking_numbers):
+        adapter = adapters[carrier_name]
+        if len(tracking_numbers) == 1:
+            future = executors[carrier_name].submit(adapter.track, tracking_numbers[0])
+        else:
+            future = executors[carrier_name].submit(adapter.track_many, tracking_numbers)
+        pending[future] = (carrier_name, tracking_numbers)
+
+    def resolve(carrier_name, tracking_number, status, error):
+        # Fan one response (or error) out to every row on the tracking number
+        nonlocal in_flight
+        if error is None:
+            response_cache.put(carrier_name, tracking_number, status)
+        waiters = waiting.pop((carrier_name, tracking_number))
+        in_flight -= len(waiters)
+        for row in waiters:
+            yield row, status, error
+
+    try:
+        while True:
+            while not exhausted and in_flight < fetch_window:
+                row = next(rows, None)
+                if row is None:
+                    exhausted = True
+                    break
+                carrier_name = row['CarrierName']
+                if carrier_name not in adapters:
+                    continue
+                key = (carrier_name, row['TrackingNumber'])
+                cached = response_cache.get(*key)
+                if cached is not None:
+                    metrics.incr('response_cache_hits')
+                    yield row, cached, None
+                    continue
+                if carrier_name in auth_failures:
+                    yield row, None, auth_failures[carrier_name]
+                    continue
+                in_flight += 1
+                if key in waiting:
+                    # Split shipments and re-ships put several orders on one tracking number
+                    metrics.incr('tracking_deduplicated')
+                    waiting[key].append(row)
+                    continue
+                waiting[key] = [row]
+                batches[carrier_name].append(row['TrackingNumber'])
+                if len(batches[carrier_name]) >= adapters[carrier_name].batch_size:
+                    submit(carrier_name, batches[carrier_name])
+                    batches[carrier_name] = []
+
+            # Send partial batches once the scan is done, or when nothing else is in flight to wait for
+            if exhausted or not pending:
+                for carrier_name, batch in batches.items():
+                    if batch:
+                        submit(carrier_name, batch)
+                        batches[carrier_name] = []
+
+            if not pending:
+                return
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                carrier_name, tracking_numbers = pending.pop(future)
+                try:
+                    details = future.result()
+                except AuthenticationError as e:
+                    auth_failures[carrier_name] = e
+                    for tracking_number in tracking_numbers:
+                        yield from resolve(carrier_name, tracking_number, None, e)
+                    continue
+                except Exception as e:
+                    if len(tracking_numbers) > 1:
+                        print(f"Batch tracking request for {len(tracking_numbers)} {carrier_name} shipments failed ({e}); tracking them individually")
+                        for tracking_number in tracking_numbers:
+                            submit(carrier_name, [tracking_number])
+                        continue
+                    yield from resolve(carrier_name, tracking_numbers[0], None, e)
+                    continue
+
+                if len(tracking_numbers) == 1:
+                    yield from resolve(carrier_name, tracking_numbers[0], details, None)
+                    continue
+
+                for tracking_number in tracking_numbers:
+                    if isinstance(details.get(tracking_number), ResponseError):
+                        yield from resolve(carrier_name, tracking_number, None, details[tracking_number])
+                    elif tracking_number in details:
+                        yield from resolve(carrier_name, tracking_number, details[tracking_number], None)
+                    else:
+                        yield from resolve(carrier_name, tracking_number, None, KeyError(f"{tracking_number} missing from batch tracking response"))
+    finally:
+        for executor in executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
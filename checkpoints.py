@@ -0,0 +1,194 @@
+import datetime
+import json
+import uuid
+from collections import deque
+
+from psycopg2 import extras
+import config
+
+
+# Stop taking new shipments once the invocation has less than this many seconds left, so the
+# last batch of writes and the checkpoint are committed before Lambda times out
+checkpoint_reserve_seconds = getattr(config, 'checkpoint_reserve_seconds', 60)
+
+# An unfinished run older than this is no longer resumed: the next invocation reports what it
+# got through and starts a fresh one
+checkpoint_max_age_hours = getattr(config, 'checkpoint_max_age_hours', 12)
+
+
+class ScanProgress:
+    # Tracks which shipments of an OrderNumber-ordered scan are fully processed. Results arrive
+    # out of order, so the checkpoint is the last order number with everything before it done,
+    # plus the few later orders that finished early.
+    def __init__(self, last_order_number=None, processed_ahead=()):
+        self.last_order_number = last_order_number
+        self.outstanding = deque()  # scanned order numbers above the watermark, in scan order
+        self.done = set(processed_ahead)
+
+    def scanned(self, order_number):
+        self.outstanding.append(order_number)
+
+    def finished(self, order_number):
+        self.done.add(order_number)
+        while self.outstanding and self.outstanding[0] in self.done:
+            self.last_order_number = self.outstanding.popleft()
+            self.done.discard(self.last_order_number)
+
+    def already_processed(self, order_number):
+        # Orders a previous invocation finished beyond its watermark
+        return order_number in self.done
+
+    def processed_ahead(self):
+        return sorted(self.done)
+
+
+# Category under which error_orders entries are stored in run_flagged_orders
+ERROR_ORDERS = 'error_orders'
+
+
+def load_flagged_orders(cursor, run_ids):
+    # Rebuild each run's order_data and error_orders from run_flagged_orders. Returns
+    # {run id: (order_data, error_orders)}; lists keep the order the entries were added in.
+    flagged = {run_id: ({}, []) for run_id in run_ids}
+    cursor.execute(
+        'SELECT "RunId", "Category", "Code", "Entry" FROM run_flagged_orders WHERE "RunId" = ANY(%s) ORDER BY "RunId", "Seq";',
+        (list(run_ids),)
+    )
+    for run_id, category, code, entry in cursor.fetchall():
+        order_data, error_orders = flagged[run_id]
+        if category == ERROR_ORDERS:
+            error_orders.append(entry)
+        else:
+            order_data.setdefault(category, {}).setdefault(code, []).append(entry)
+    return flagged
+
+
+def delete_flagged_orders(cursor, run_ids):
+    cursor.execute('DELETE FROM run_flagged_orders WHERE "RunId" = ANY(%s);', (list(run_ids),))
+
+
+def expired_runs(cursor, current_date):
+    # Claim the unfinished unsharded runs too old to resume. Returns (subject, aggregates) for
+    # each, covering its progress so far; the caller sends the reports and commits. Runs another
+    # invocation is reporting are skipped.
+    cursor.execute(
+        'SELECT "RunId", "LastOrderNumber", "Aggregates" FROM run_checkpoints '
+        'WHERE NOT "Completed" AND "ParentRunId" IS NULL AND "StartedAt" <= %s ORDER BY "StartedAt" FOR UPDATE SKIP LOCKED;',
+        (current_date - datetime.timedelta(hours=checkpoint_max_age_hours),)
+    )
+    runs = cursor.fetchall()
+    if not runs:
+        return []
+    flagged = load_flagged_orders(cursor, [run_id for run_id, last_order_number, aggregates in runs])
+    reports = []
+    for run_id, last_order_number, aggregates in runs:
+        aggregates['order_data'], aggregates['error_orders'] = flagged[run_id]
+        reports.append((f"{aggregates['report_subject']} (incomplete: stopped after order {last_order_number})", aggregates))
+    run_ids = list(flagged)
+    delete_flagged_orders(cursor, run_ids)
+    cursor.execute('UPDATE run_checkpoints SET "Completed" = true, "UpdatedAt" = now() WHERE "RunId" = ANY(%s);', (run_ids,))
+    return reports
+
+
+class Checkpoint:
+    # The report counters are saved with the checkpoint row. Flagged orders (order_data and
+    # error_orders) only ever grow, so each save appends the entries added since the last one to
+    # run_flagged_orders instead of rewriting them all.
+    def __init__(self, run_id, started_at, progress, aggregates=None, resumed=False, parent_run_id=None, completed=False):
+        self.run_id = run_id
+        self.parent_run_id = parent_run_id  # the sharded run this is one worker's part of
+        self.started_at = started_at
+        self.progress = progress
+        self.aggregates = aggregates or {}
+        self.resumed = resumed
+        self.completed = completed
+        # How many entries of each order_data list and of error_orders are already saved
+        order_data = self.aggregates.get('order_data', {})
+        self.saved_orders = {(category, code): len(orders) for category, orders_by_code in order_data.items() for code, orders in orders_by_code.items()}
+        self.saved_errors = len(self.aggregates.get('error_orders', []))
+        self.next_seq = sum(self.saved_orders.values()) + self.saved_errors
+
+    @classmethod
+    def open(cls, cursor, current_date):
+        # Resume the latest unfinished run, or start a new one
+        cursor.execute(
+            'SELECT "RunId", "StartedAt", "LastOrderNumber", "ProcessedAhead", "Aggregates" FROM run_checkpoints '
+            'WHERE NOT "Completed" AND "ParentRunId" IS NULL AND "StartedAt" > %s ORDER BY "StartedAt" DESC LIMIT 1;',
+            (current_date - datetime.timedelta(hours=checkpoint_max_age_hours),)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return cls(uuid.uuid4().hex, current_date, ScanProgress())
+        run_id, started_at, last_order_number, processed_ahead, aggregates = row
+        aggregates['order_data'], aggregates['error_orders'] = load_flagged_orders(cursor, [run_id])[run_id]
+        return cls(run_id, started_at, ScanProgress(last_order_number, processed_ahead), aggregates, resumed=True)
+
+    @classmethod
+    def open_shard(cls, cursor, current_date, run_id, parent_run_id):
+        # A shard worker's checkpoint is looked up by its id, so a re-invoked worker continues its own shard
+        cursor.execute(
+            'SELECT "StartedAt", "LastOrderNumber", "ProcessedAhead", "Aggregates", "Completed" FROM run_checkpoints WHERE "RunId" = %s;',
+            (run_id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return cls(run_id, current_date, ScanProgress(), parent_run_id=parent_run_id)
+        started_at, last_order_number, processed_ahead, aggregates, completed = row
+        aggregates['order_data'], aggregates['error_orders'] = load_flagged_orders(cursor, [run_id])[run_id]
+        return cls(run_id, started_at, ScanProgress(last_order_number, processed_ahead), aggregates, True, parent_run_id, completed)
+
+    def save(self, cursor, aggregates, completed=False):
+        # Written in the same transaction as the flushed shipment writes it describes. A completed
+        # unsharded run has sent its report, so its flagged orders are dropped; a shard's are
+        # kept until finish_shard merges them.
+        self.aggregates = aggregates
+        self.completed = completed
+        if completed and self.parent_run_id is None:
+            delete_flagged_orders(cursor, [self.run_id])
+        else:
+            self.save_flagged_orders(cursor, aggregates['order_data'], aggregates['error_orders'])
+        counters = {key: value for key, value in aggregates.items() if key not in ('order_data', 'error_orders')}
+        cursor.execute('''
+            INSERT INTO run_checkpoints ("RunId", "ParentRunId", "StartedAt", "UpdatedAt", "LastOrderNumber", "ProcessedAhead", "Aggregates", "Completed")
+            VALUES (%s, %s, %s, now(), %s, %s, %s, %s)
+            ON CONFLICT ("RunId") DO UPDATE SET
+                "UpdatedAt" = now(),
+                "LastOrderNumber" = EXCLUDED."LastOrderNumber",
+                "ProcessedAhead" = EXCLUDED."ProcessedAhead",
+                "Aggregates" = EXCLUDED."Aggregates",
+                "Completed" = EXCLUDED."Completed";
+        ''', (
+            self.run_id,
+            self.parent_run_id,
+            self.started_at,
+            self.progress.last_order_number,
+            json.dumps(self.progress.processed_ahead()),
+            json.dumps(counters, default=str),
+            completed,
+        ))
+
+    def save_flagged_orders(self, cursor, order_data, error_orders):
+        rows = []
+        for category, orders_by_code in order_data.items():
+            for code, orders in orders_by_code.items():
+                saved = self.saved_orders.get((category, code), 0)
+                rows.extend((category, code, order) for order in orders[saved:])
+                self.saved_orders[(category, code)] = len(orders)
+        rows.extend((ERROR_ORDERS, '', error_order) for error_order in error_orders[self.saved_errors:])
+        self.saved_errors = len(error_orders)
+        if not rows:
+            return
+        extras.execute_values(
+            cursor,
+            'INSERT INTO run_flagged_orders ("RunId", "Seq", "Category", "Code", "Entry") VALUES %s;',
+            [(self.run_id, self.next_seq + i, category, code, json.dumps(entry, default=str)) for i, (category, code, entry) in enumerate(rows)],
+            page_size=1000
+        )
+        self.next_seq += len(rows)
+
+
+def time_left(context):
+    # Seconds left in the Lambda invocation, or None when run outside Lambda
+    if context is None or not hasattr(context, 'get_remaining_time_in_millis'):
+        return None
+    return context.get_remaining_time_in_millis() / 1000
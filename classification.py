@@ -0,0 +1,128 @@
+import config
+from business_days import calendar
+
+
+# Email categories: every category except 'alert' counts as a problem order in the report
+STUCK = 'stuck'
+PROBLEM = 'problem'
+DELAY = 'delay'
+ALERT = 'alert'
+
+# classify() returns an ordered list of actions, each a tuple starting with its kind:
+#   ("update", {column: value})                       buffered column update on shipments
+#   ("move", target_table, notification_update)       move the order out of shipments
+#   ("email", category, status_entry)                 add the order to the report under status_entry
+#   ("log", message)                                  informational message for the run log
+
+
+def calculate_days(date1, date2):
+    return calendar.count(date1, date2)
+
+
+def classify(state, status, current_date):
+    # Decide what to do with one shipment. state is the shipment's current column values (the
+    # scanned row with any pending updates applied), status the parsed carrier response.
+    # No I/O happens here, so recorded responses can be replayed offline (see test_classification.py).
+    if status.carrier == 'USPS':
+        return classify_usps(state, status, current_date)
+    return classify_ups(state, status, current_date)
+
+
+def classify_usps(state, status, current_date):
+    actions = [("update", {"StatusCode": status.category, "LastLocation": status.city})]
+
+    if 'Delivered' in status.category:
+        actions.append(("update", {"Delivered": 'Yes'}))
+        actions.append(("move", "delivered", False))
+    elif status.category == 'Pre-Shipment' and status.category == state["StatusCode"]:
+        # Calculate days since the ShippedDate
+        days_since_shipped = calculate_days(state["ShippedDate"], current_date)
+
+        if days_since_shipped >= 3:
+            actions.append(("move", "problem_orders", True))
+            actions.append(("email", STUCK, "Status Stuck at 'Pre-Shipment' for 3 or More Business Days"))
+
+        # Update DaysAtLastLocation with the calculated days
+        actions.append(("update", {"DaysAtLastLocation": days_since_shipped}))
+
+    elif status.category == 'Alert':
+        if status.description in config.problem_codes_usps:
+            actions.append(("move", "problem_orders", True))
+            actions.append(("email", PROBLEM, status.description))
+        else:
+            if state['NotificationSent'] == 'No':
+                actions.append(("update", {"NotificationSent": 'Yes'}))
+                actions.append(("email", ALERT, status.description))
+    return actions
+
+
+def classify_ups(state, status, current_date):
+    actions = []
+    status_code = status.code
+    new_status_entry = f"{status_code}: {status.description}"
+    is_delivered = status_code in config.delivered_codes
+    is_problem_code = status_code in config.problem_codes_ups
+    is_delayed = status_code in config.delay_codes
+
+    # Update the StatusCode in the database
+    actions.append(("update", {"StatusCode": new_status_entry}))
+
+    # Check for '003' status code and days since shipment
+    if status_code == '003' and calculate_days(state['ShippedDate'], current_date) >= 3:
+        is_problem_code = True
+
+    # Process current location
+    try:
+        current_location = status.city
+        previous_location = state["LastLocation"]
+        previous_location_date = state["LastLocationDate"]
+        if current_location is None:
+            actions.append(("log", f"Error processing order {state['OrderNumber']}: no location in the latest activity"))
+        # Check if LastLocation exists
+        elif previous_location:
+            if current_location != previous_location:
+                if status.activity_date is None:
+                    actions.append(("log", f"Error processing order {state['OrderNumber']}: no date in the latest activity"))
+                else:
+                    # Update LastLocation, set LastLocationDate to activity date and DaysAtLastLocation to the difference between activity date and current date
+                    days_at_location = calculate_days(status.activity_date, current_date)
+                    actions.append(("update", {"LastLocation": current_location, "LastLocationDate": status.activity_date, "DaysAtLastLocation": days_at_location}))
+            else:
+                # Calculate days at current location
+                if previous_location_date is not None:
+                    days_at_location = calculate_days(previous_location_date, current_date)
+                    actions.append(("update", {"DaysAtLastLocation": days_at_location}))
+
+                    # If shipment hasn't moved, only address it if it has no estimated delivery date
+                    if days_at_location >= 3 and not status.delivery_date:
+                        notification_status = state["NotificationSent"]
+                        if days_at_location >= 5 and notification_status == 'No':
+                            actions.append(("email", STUCK, '999: 5 Business Days without a Location Update, and No Delivery Date Found'))
+                            actions.append(("move", "problem_orders", True))
+
+                        elif days_at_location == 3:
+                            if notification_status == 'No':
+                                actions.append(("email", STUCK, '998: 3 Business Days without a Location Update, and No Delivery Date Found'))
+                                actions.append(("update", {"NotificationSent": 'Yes'}))
+                            else:
+                                actions.append(("update", {"NotificationSent": 'No'}))
+
+                else:
+                    # If LastLocationDate is None, set it to the current date and DaysAtLastLocation to 0
+                    actions.append(("update", {"LastLocationDate": current_date, "DaysAtLastLocation": 0}))
+    except Exception as e:
+        actions.append(("log", f"Error processing order {state['OrderNumber']}: {e}"))
+    if is_delivered:
+        actions.append(("update", {"Delivered": 'Yes'}))
+        actions.append(("move", "delivered", False))
+
+    elif is_problem_code:
+        if is_delayed:
+            # If the order is already marked as delayed, it has already been reported
+            if state["Delayed"] == 'No':
+                actions.append(("email", DELAY, new_status_entry))
+                actions.append(("update", {"Delayed": 'Yes'}))
+        else:
+            actions.append(("email", PROBLEM, new_status_entry))
+            actions.append(("move", "problem_orders", True))
+    return actions
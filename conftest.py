@@ -0,0 +1,11 @@
+import sys
+import types
+
+
+# The deployed config module holds credentials and isn't part of the repository. Tests get a
+# minimal stand-in with only what importing the modules under test reads; each test pins any
+# other setting it depends on.
+if 'config' not in sys.modules:
+    config = types.ModuleType('config')
+    config.us_holidays_2023 = {}
+    sys.modules['config'] = config
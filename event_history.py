@@ -0,0 +1,216 @@
+import datetime
+
+from psycopg2 import extras, Error
+import config
+from polling_schedule import response_summary
+from shipment_store import PRODUCT_COLUMNS
+
+
+# Keep one row per distinct carrier event in tracking_events, alongside the in-place shipment columns
+event_history = getattr(config, 'event_history', True)
+
+# Monthly event partitions older than this are dropped by the maintenance job
+event_retention_days = getattr(config, 'event_retention_days', 400)
+
+# Delivered orders shipped more than this many days ago are compacted into delivered_summary
+delivered_retention_days = getattr(config, 'delivered_retention_days', 90)
+
+# Monthly partitions created ahead of the current month, so new events never land in the default partition
+event_partitions_ahead = getattr(config, 'event_partitions_ahead', 2)
+
+# Delivered rows compacted per transaction
+archive_batch_size = getattr(config, 'archive_batch_size', 5000)
+
+
+def month_start(day, months_ahead=0):
+    month = day.month - 1 + months_ahead
+    return datetime.date(day.year + month // 12, month % 12 + 1, 1)
+
+
+def partition_name(month):
+    return f"tracking_events_{month:%Y%m}"
+
+
+def event_partitions(cursor):
+    cursor.execute('''
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'tracking_events'::regclass;
+    ''')
+    return [name for (name,) in cursor.fetchall()]
+
+
+def ensure_partitions(cursor, current_date):
+    # Partitions for this month and the next event_partitions_ahead months
+    existing = set(event_partitions(cursor))
+    for months_ahead in range(event_partitions_ahead + 1):
+        month = month_start(current_date, months_ahead)
+        if partition_name(month) not in existing:
+            ensure_partition(cursor, month)
+
+
+def ensure_partition(cursor, month):
+    try:
+        cursor.execute("SAVEPOINT event_partition;")
+        cursor.execute(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF tracking_events FOR VALUES FROM (%s) TO (%s);",
+            (month, month_start(month, 1))
+        )
+        cursor.execute("RELEASE SAVEPOINT event_partition;")
+    except Error as e:
+        # Fails if another invocation just created it, or if the default partition already holds
+        # events for the month; those events stay there
+        print(f"Could not create event partition {partition_name(month)}: {e}")
+        cursor.execute("ROLLBACK TO SAVEPOINT event_partition;")
+
+
+def parse_event_time(value):
+    # UPS gives YYYYMMDDHHMMSS (date and time concatenated), USPS an ISO 8601 timestamp. Times
+    # are kept as the carrier's local wall-clock time.
+    if not value:
+        return None
+    value = str(value)
+    try:
+        if value.isdigit():
+            return datetime.datetime.strptime(value[:14].ljust(14, '0'), "%Y%m%d%H%M%S")
+        return datetime.datetime.fromisoformat(value.replace('Z', '+00:00')).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+class CodeDictionary:
+    # Maps values to the integer ids of a dictionary table, adding values it hasn't seen.
+    # Ids are looked up per invocation, so nothing stale survives a rebuilt table.
+    def __init__(self, table, id_column, key_columns):
+        self.table = table
+        self.id_column = id_column
+        self.key_columns = key_columns
+        self.ids = {}
+
+    def resolve(self, cursor, keys):
+        missing = list({key for key in keys if key not in self.ids})
+        if missing:
+            column_names = ", ".join([f"\"{column}\"" for column in self.key_columns])
+            extras.execute_values(
+                cursor,
+                f"INSERT INTO {self.table} ({column_names}) VALUES %s ON CONFLICT DO NOTHING;",
+                missing,
+                page_size=1000
+            )
+            rows = extras.execute_values(
+                cursor,
+                f"SELECT \"{self.id_column}\", {column_names} FROM {self.table} JOIN (VALUES %s) AS k ({column_names}) USING ({column_names});",
+                missing,
+                page_size=1000,
+                fetch=True
+            )
+            for row_id, *key in rows:
+                self.ids[tuple(key)] = row_id
+        return self.ids
+
+
+class EventHistory:
+    # Buffers the latest event of each tracking response and appends the new ones to
+    # tracking_events when the shipment writes are flushed
+    def __init__(self):
+        self.events = {}  # (tracking number, event time, (carrier, status, detail)) -> city
+        self.statuses = CodeDictionary("tracking_statuses", "StatusId", ("CarrierName", "Status", "Detail"))
+        self.locations = CodeDictionary("tracking_locations", "LocationId", ("City",))
+
+    def __len__(self):
+        return len(self.events)
+
+    def record(self, tracking_number, status):
+        summary = response_summary(status)
+        if not summary['status']:
+            return
+        event_time = parse_event_time(summary['event_time'])
+        if event_time is None:
+            return
+        status_key = (status.carrier, str(summary['status']), str(summary.get('detail') or ''))
+        # Orders sharing a tracking number report the same event once
+        self.events.setdefault((tracking_number, event_time, status_key), status.city)
+
+    def flush(self, cursor):
+        if not self.events:
+            return
+        try:
+            cursor.execute("SAVEPOINT event_history;")
+            status_ids = self.statuses.resolve(cursor, [status for tracking_number, event_time, status in self.events])
+            location_ids = self.locations.resolve(cursor, [(city,) for city in self.events.values() if city])
+            rows = [
+                (tracking_number, event_time, status_ids[status], location_ids[(city,)] if city else None)
+                for (tracking_number, event_time, status), city in self.events.items()
+            ]
+            extras.execute_values(
+                cursor,
+                'INSERT INTO tracking_events ("TrackingNumber", "EventTime", "StatusId", "LocationId") VALUES %s ON CONFLICT DO NOTHING;',
+                rows,
+                page_size=1000
+            )
+            cursor.execute("RELEASE SAVEPOINT event_history;")
+        except Error as e:
+            # History is a record alongside the shipment writes and never holds them up
+            print(f"Error recording {len(self.events)} tracking events: {e}")
+            cursor.execute("ROLLBACK TO SAVEPOINT event_history;")
+            self.statuses.ids.clear()
+            self.locations.ids.clear()
+        self.events.clear()
+
+
+def drop_expired_partitions(cursor, current_date):
+    # Whole months are dropped once every event in them is past retention; the default
+    # partition is trimmed row by row
+    cutoff = (current_date - datetime.timedelta(days=event_retention_days)).replace(tzinfo=None)
+    dropped = 0
+    for name in event_partitions(cursor):
+        suffix = name.rsplit('_', 1)[-1]
+        if not suffix.isdigit():
+            continue
+        month = datetime.date(int(suffix[:4]), int(suffix[4:]), 1)
+        if datetime.datetime.combine(month_start(month, 1), datetime.time()) <= cutoff:
+            cursor.execute(f"DROP TABLE {name};")
+            dropped += 1
+    cursor.execute('DELETE FROM tracking_events_default WHERE "EventTime" < %s;', (cutoff,))
+    return dropped, cursor.rowcount
+
+
+def archive_delivered(cnx, cursor, current_date):
+    # Replace delivered orders past retention with per-month, per-carrier summary rows, one
+    # batch per transaction. Returns the number of orders archived.
+    cutoff = current_date.date() - datetime.timedelta(days=delivered_retention_days)
+    product_columns = ", ".join([f"\"{column}\"" for column in PRODUCT_COLUMNS])
+    product_sums = ", ".join([f"coalesce(sum(\"{column}\"), 0)" for column in PRODUCT_COLUMNS])
+    product_updates = ", ".join([f"\"{column}\" = delivered_summary.\"{column}\" + EXCLUDED.\"{column}\"" for column in PRODUCT_COLUMNS])
+    archived = 0
+    while True:
+        cursor.execute(f'''
+            WITH archived AS (
+                DELETE FROM delivered WHERE "OrderNumber" IN (
+                    SELECT "OrderNumber" FROM delivered WHERE "ShippedDate" < %s LIMIT %s
+                ) RETURNING *
+            ), summarised AS (
+                INSERT INTO delivered_summary ("ShipMonth", "CarrierName", "Orders", {product_columns})
+                SELECT date_trunc('month', "ShippedDate")::date, coalesce("CarrierName", ''), count(*), {product_sums}
+                FROM archived GROUP BY 1, 2
+                ON CONFLICT ("ShipMonth", "CarrierName") DO UPDATE SET
+                    "Orders" = delivered_summary."Orders" + EXCLUDED."Orders", {product_updates}
+            )
+            SELECT count(*) FROM archived;
+        ''', (cutoff, archive_batch_size))
+        batch = cursor.fetchone()[0]
+        cnx.commit()
+        archived += batch
+        if batch < archive_batch_size:
+            return archived
+
+
+def run_maintenance(cnx, cursor, current_date):
+    # Retention job: create upcoming event partitions, drop expired ones and compact old delivered orders
+    ensure_partitions(cursor, current_date)
+    dropped, trimmed = drop_expired_partitions(cursor, current_date)
+    cnx.commit()
+    print(f"Dropped {dropped} expired event partitions and {trimmed} expired events from the default partition")
+    archived = archive_delivered(cnx, cursor, current_date)
+    print(f"Archived {archived} delivered orders into delivered_summary")
+    return {'partitions_dropped': dropped, 'events_trimmed': trimmed, 'orders_archived': archived}
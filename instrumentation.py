@@ -0,0 +1,126 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2 import extras
+import config
+
+
+# Messages below this level are dropped; per-shipment messages are logged at DEBUG
+log_level = getattr(config, 'log_level', 'INFO')
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+# 'json' prints a plain JSON summary per run; 'emf' wraps it in CloudWatch Embedded Metric Format
+metrics_format = getattr(config, 'metrics_format', 'json')
+metrics_namespace = getattr(config, 'metrics_namespace', 'TrackingNotifier')
+
+
+def debug(message):
+    if LOG_LEVELS.get(log_level, 20) <= LOG_LEVELS['DEBUG']:
+        print(message)
+
+
+class Metrics:
+    # Per-run stage timings and counters, safe to update from the carrier worker threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.timings = {}  # stage -> [count, total seconds, max seconds]
+            self.counters = {}
+            self.started = time.perf_counter()
+
+    def incr(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def record(self, stage, seconds):
+        with self.lock:
+            timing = self.timings.setdefault(stage, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += seconds
+            timing[2] = max(timing[2], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - started)
+
+    def summary(self, **run_values):
+        with self.lock:
+            stages = {
+                stage: {'count': count, 'total_ms': round(total * 1000, 1), 'max_ms': round(longest * 1000, 1)}
+                for stage, (count, total, longest) in self.timings.items()
+            }
+            counters = dict(self.counters)
+        return {
+            'duration_ms': round((time.perf_counter() - self.started) * 1000, 1),
+            'stages': stages,
+            'counters': {**counters, **run_values},
+        }
+
+    def emit(self, **run_values):
+        summary = self.summary(**run_values)
+        if metrics_format != 'emf':
+            print(json.dumps(summary, default=str))
+            return
+
+        # Flatten into one EMF document: stage totals in milliseconds, everything else as counts
+        values = {'duration_ms': summary['duration_ms']}
+        units = {'duration_ms': 'Milliseconds'}
+        for stage, timing in summary['stages'].items():
+            values[f"{stage}_ms"] = timing['total_ms']
+            units[f"{stage}_ms"] = 'Milliseconds'
+            values[f"{stage}_count"] = timing['count']
+            units[f"{stage}_count"] = 'Count'
+        for name, value in summary['counters'].items():
+            if isinstance(value, (int, float)):
+                values[name] = value
+                units[name] = 'Bytes' if name.endswith('_bytes') else 'Count'
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': metrics_namespace,
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, unit in units.items()],
+                }],
+            },
+            'Service': 'tracking-notifier',
+            **values,
+        }))
+
+
+metrics = Metrics()
+
+
+class TimedCursor(extras.DictCursor):
+    # DictCursor that times every statement and counts database round-trips. On a named
+    # (server-side) cursor each fetch is a FETCH round-trip as well; iterating one fetches
+    # inside psycopg2 where it can't be counted, so scans over named cursors call fetchmany().
+    def execute(self, query, vars=None):
+        metrics.incr('db_round_trips')
+        with metrics.timer('db_statement'):
+            return super().execute(query, vars)
+
+    def timed_fetch(self, fetch, *args):
+        if self.name is None:
+            return fetch(*args)
+        metrics.incr('db_round_trips')
+        with metrics.timer('db_statement'):
+            return fetch(*args)
+
+    def fetchone(self):
+        return self.timed_fetch(super().fetchone)
+
+    def fetchmany(self, size=None):
+        return self.timed_fetch(super().fetchmany, self.arraysize if size is None else size)
+
+    def fetchall(self):
+        return self.timed_fetch(super().fetchall)
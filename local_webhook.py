@@ -0,0 +1,105 @@
+import argparse
+import glob
+import json
+import os
+import random
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+# Local stand-in for the API Gateway endpoint in front of lambda_handler, plus a client that
+# replays recorded carrier webhook payloads against it, and a mock SendGrid endpoint that
+# accepts and logs mail sends (set config.sendgrid_host to its URL).
+#
+#   python local_webhook.py serve --port 8080
+#   python local_webhook.py replay recorded_events/ --url http://localhost:8080/ [--credential SECRET]
+#   python local_webhook.py sendgrid --port 8090 --fail-rate 0.1
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        from tracking_notifier import lambda_handler
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        try:
+            # Same event shape API Gateway's proxy integration hands to the function
+            lambda_handler({'body': body, 'headers': dict(self.headers)}, None)
+        except Exception as e:
+            self.send_response(500)
+            self.end_headers()
+            self.wfile.write(str(e).encode())
+            return
+        self.send_response(200)
+        self.end_headers()
+
+
+class MockSendGridHandler(BaseHTTPRequestHandler):
+    fail_rate = 0.0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path != '/v3/mail/send':
+            self.send_response(404)
+            self.end_headers()
+            return
+        if random.random() < self.fail_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+        recipients = [to['email'] for personalization in body.get('personalizations', []) for to in personalization.get('to', [])]
+        print(f"{body.get('subject')!r}: {len(recipients)} recipient(s), {len(body.get('attachments', []))} attachment(s)")
+        self.send_response(202)
+        self.send_header('X-Message-Id', f"mock-{random.getrandbits(48):012x}")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_sendgrid(port, fail_rate):
+    MockSendGridHandler.fail_rate = fail_rate
+    server = ThreadingHTTPServer(('127.0.0.1', port), MockSendGridHandler)
+    print(f"Mock SendGrid listening on http://127.0.0.1:{port}/v3/mail/send")
+    server.serve_forever()
+
+
+def serve(port):
+    server = ThreadingHTTPServer(('127.0.0.1', port), WebhookHandler)
+    print(f"Forwarding POSTs on http://127.0.0.1:{port}/ to lambda_handler")
+    server.serve_forever()
+
+
+def replay(path, url, credential=None):
+    # Sends the credential header the handler checks, as UPS does for Track Alert subscriptions
+    if credential is None:
+        import config
+        credential = getattr(config, 'tracking_webhook_credential', None)
+    headers = {'credential': credential} if credential else {}
+    paths = sorted(glob.glob(os.path.join(path, '*.json'))) if os.path.isdir(path) else [path]
+    for payload_path in paths:
+        with open(payload_path) as f:
+            payload = json.load(f)
+        response = requests.post(url, json=payload, headers=headers, timeout=60)
+        print(f"{payload_path}: {response.status_code}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    replay_parser = commands.add_parser('replay')
+    replay_parser.add_argument('path', help="Recorded payload file, or a directory of *.json payloads")
+    replay_parser.add_argument('--url', default='http://127.0.0.1:8080/')
+    replay_parser.add_argument('--credential', help="Value of the credential header; defaults to config.tracking_webhook_credential")
+    sendgrid_parser = commands.add_parser('sendgrid')
+    sendgrid_parser.add_argument('--port', type=int, default=8090)
+    sendgrid_parser.add_argument('--fail-rate', type=float, default=0.0, help="Fraction of sends answered with 503")
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.port)
+    elif args.command == 'sendgrid':
+        serve_sendgrid(args.port, args.fail_rate)
+    else:
+        replay(args.path, args.url, args.credential)
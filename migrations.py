@@ -0,0 +1,243 @@
+import argparse
+
+import config
+
+
+# Apply pending migrations at the start of each invocation. With this off, run
+# `python migrations.py --dsn ...` before deploying a version that needs them.
+auto_migrate = getattr(config, 'auto_migrate', True)
+
+# Key of the advisory lock that keeps concurrent invocations from migrating at the same time
+MIGRATION_LOCK = 7261004
+
+
+def create_core_tables(cursor):
+    # Tables that existed before the schema was managed here are left as they are
+    from shipment_store import PRODUCT_COLUMNS
+
+    product_columns = ", ".join([f"\"{column}\" integer DEFAULT 0" for column in PRODUCT_COLUMNS])
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS shipments (
+            "OrderNumber" text PRIMARY KEY,
+            "CustomerName" text,
+            "CustomerEmail" text,
+            "TrackingNumber" text,
+            "CarrierName" text,
+            "ShippedDate" date,
+            "StatusCode" text,
+            "LastLocation" text,
+            "LastLocationDate" date,
+            "DaysAtLastLocation" integer,
+            "NotificationSent" text DEFAULT 'No',
+            "Delayed" text DEFAULT 'No',
+            "Delivered" text DEFAULT 'No',
+            {product_columns}
+        );
+        CREATE TABLE IF NOT EXISTS delivered (LIKE shipments INCLUDING ALL);
+        CREATE TABLE IF NOT EXISTS problem_orders (LIKE shipments INCLUDING ALL);
+    ''')
+
+
+def create_poll_state_table(cursor):
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shipment_poll_state (
+            "OrderNumber" text PRIMARY KEY,
+            "LastPolled" timestamptz NOT NULL,
+            "LastEventTime" text,
+            "ExpectedDelivery" date,
+            "Fingerprint" text,
+            "UnchangedPolls" integer NOT NULL DEFAULT 0
+        );
+    ''')
+
+
+def create_run_tables(cursor):
+    # customer_notifications holds one row per (order, status) a customer has been emailed
+    # about. A row is claimed before the send and removed again if the send fails, so a
+    # retried run never emails twice.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS run_checkpoints (
+            "RunId" text PRIMARY KEY,
+            "ParentRunId" text,
+            "StartedAt" timestamptz NOT NULL,
+            "UpdatedAt" timestamptz NOT NULL,
+            "LastOrderNumber" text,
+            "ProcessedAhead" jsonb NOT NULL DEFAULT '[]',
+            "Aggregates" jsonb NOT NULL DEFAULT '{}',
+            "Completed" boolean NOT NULL DEFAULT false
+        );
+        CREATE TABLE IF NOT EXISTS sharded_runs (
+            "RunId" text PRIMARY KEY,
+            "StartedAt" timestamptz NOT NULL,
+            "ShardCount" integer NOT NULL,
+            "Partition" text NOT NULL,
+            "ReportSubject" text NOT NULL,
+            "ReportSent" boolean NOT NULL DEFAULT false
+        );
+        CREATE TABLE IF NOT EXISTS customer_notifications (
+            "OrderNumber" text NOT NULL,
+            "Status" text NOT NULL,
+            "Category" text NOT NULL,
+            "CustomerEmail" text NOT NULL,
+            "ClaimedAt" timestamptz NOT NULL DEFAULT now(),
+            "SentAt" timestamptz,
+            PRIMARY KEY ("OrderNumber", "Status")
+        );
+    ''')
+
+
+def create_event_history_tables(cursor):
+    # Statuses and cities are stored once in small dictionary tables and referenced by integer
+    # id, so an event row is a tracking number, a timestamp and two small integers. Monthly
+    # partitions of tracking_events are created at run time by event_history.ensure_partitions.
+    from shipment_store import PRODUCT_COLUMNS
+
+    product_columns = ", ".join([f"\"{column}\" bigint NOT NULL DEFAULT 0" for column in PRODUCT_COLUMNS])
+    cursor.execute(f'''
+        CREATE TABLE IF NOT EXISTS tracking_statuses (
+            "StatusId" smallserial PRIMARY KEY,
+            "CarrierName" text NOT NULL,
+            "Status" text NOT NULL,
+            "Detail" text NOT NULL DEFAULT '',
+            UNIQUE ("CarrierName", "Status", "Detail")
+        );
+        CREATE TABLE IF NOT EXISTS tracking_locations (
+            "LocationId" serial PRIMARY KEY,
+            "City" text NOT NULL UNIQUE
+        );
+        CREATE TABLE IF NOT EXISTS tracking_events (
+            "TrackingNumber" text NOT NULL,
+            "EventTime" timestamp NOT NULL,
+            "StatusId" smallint NOT NULL,
+            "LocationId" integer,
+            "RecordedAt" timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY ("TrackingNumber", "EventTime", "StatusId")
+        ) PARTITION BY RANGE ("EventTime");
+        CREATE TABLE IF NOT EXISTS tracking_events_default PARTITION OF tracking_events DEFAULT;
+        CREATE TABLE IF NOT EXISTS delivered_summary (
+            "ShipMonth" date NOT NULL,
+            "CarrierName" text NOT NULL,
+            "Orders" integer NOT NULL DEFAULT 0,
+            {product_columns},
+            PRIMARY KEY ("ShipMonth", "CarrierName")
+        );
+    ''')
+
+
+def create_access_path_indexes(cursor):
+    # Only what the tracker's statements filter on; shard pages and resumed scans already walk
+    # the OrderNumber primary key. The NotificationSent and Delayed flags are read from scanned
+    # rows, never filtered on, so they get no index to maintain.
+    cursor.execute('''
+        -- Pushed tracking events look shipments up by tracking number
+        CREATE INDEX IF NOT EXISTS shipments_tracking_number_idx ON shipments ("TrackingNumber");
+        -- The retention job selects delivered orders by ship date
+        CREATE INDEX IF NOT EXISTS delivered_shipped_date_idx ON delivered ("ShippedDate");
+        -- Resuming looks for the latest unfinished unsharded run; almost every row is finished
+        CREATE INDEX IF NOT EXISTS run_checkpoints_unfinished_idx ON run_checkpoints ("StartedAt")
+            WHERE NOT "Completed" AND "ParentRunId" IS NULL;
+        -- The last shard worker collects its siblings' checkpoints
+        CREATE INDEX IF NOT EXISTS run_checkpoints_parent_idx ON run_checkpoints ("ParentRunId")
+            WHERE "ParentRunId" IS NOT NULL;
+    ''')
+
+
+def create_flagged_orders_table(cursor):
+    # Report entries of in-progress runs, appended a checkpoint at a time. Category is an
+    # order_data category or 'error_orders', Code the status entry the order is listed under.
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS run_flagged_orders (
+            "RunId" text NOT NULL,
+            "Seq" integer NOT NULL,
+            "Category" text NOT NULL,
+            "Code" text NOT NULL,
+            "Entry" jsonb NOT NULL,
+            PRIMARY KEY ("RunId", "Seq")
+        );
+    ''')
+
+
+def drop_moved_order_keys(cursor):
+    # LIKE ... INCLUDING ALL copied the shipments primary key into the tables orders are moved
+    # to, so an order ingested again after it was moved could never be moved again. They hold one
+    # row per move, as before the migrations; a plain index keeps OrderNumber lookups cheap.
+    cursor.execute('''
+        ALTER TABLE delivered DROP CONSTRAINT IF EXISTS delivered_pkey;
+        ALTER TABLE problem_orders DROP CONSTRAINT IF EXISTS problem_orders_pkey;
+        CREATE INDEX IF NOT EXISTS delivered_order_number_idx ON delivered ("OrderNumber");
+        CREATE INDEX IF NOT EXISTS problem_orders_order_number_idx ON problem_orders ("OrderNumber");
+    ''')
+
+
+# Applied in order and recorded in schema_migrations. Never edit or renumber an applied
+# migration; add a new one instead.
+MIGRATIONS = (
+    (1, "core tables", create_core_tables),
+    (2, "shipment poll state", create_poll_state_table),
+    (3, "checkpoint, sharded run and notification tables", create_run_tables),
+    (4, "tracking event history", create_event_history_tables),
+    (5, "access path indexes", create_access_path_indexes),
+    (6, "run flagged orders", create_flagged_orders_table),
+    (7, "no primary key on moved orders", drop_moved_order_keys),
+)
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def current_version(cursor):
+    cursor.execute("SELECT to_regclass('schema_migrations') IS NOT NULL;")
+    if not cursor.fetchone()[0]:
+        return 0
+    cursor.execute('SELECT coalesce(max("Version"), 0) FROM schema_migrations;')
+    return cursor.fetchone()[0]
+
+
+def migrate(cnx):
+    # Apply any pending migrations and commit them. Returns the versions applied; an up-to-date
+    # schema costs two quick statements.
+    cursor = cnx.cursor()
+    if current_version(cursor) >= LATEST_VERSION:
+        cursor.close()
+        return []
+
+    cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK,))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            "Version" integer PRIMARY KEY,
+            "Name" text NOT NULL,
+            "AppliedAt" timestamptz NOT NULL DEFAULT now()
+        );
+    ''')
+    # Another invocation may have migrated while this one waited for the lock
+    cursor.execute('SELECT "Version" FROM schema_migrations;')
+    applied_versions = {version for (version,) in cursor.fetchall()}
+    applied = []
+    for version, name, apply in MIGRATIONS:
+        if version in applied_versions:
+            continue
+        apply(cursor)
+        cursor.execute('INSERT INTO schema_migrations ("Version", "Name") VALUES (%s, %s);', (version, name))
+        print(f"Applied migration {version}: {name}")
+        applied.append(version)
+    cnx.commit()
+    cursor.close()
+    return applied
+
+
+def main():
+    import psycopg2
+
+    parser = argparse.ArgumentParser(description="Apply pending schema migrations")
+    parser.add_argument('--dsn', help="libpq connection string; defaults to the database in config")
+    args = parser.parse_args()
+
+    if args.dsn:
+        cnx = psycopg2.connect(args.dsn)
+    else:
+        cnx = psycopg2.connect(dbname=config.dbname, user=config.user, password=config.pw, host=config.host, port=config.port)
+    applied = migrate(cnx)
+    cnx.close()
+    print(f"Schema at version {LATEST_VERSION}; {len(applied)} migration(s) applied")
+
+
+if __name__ == '__main__':
+    main()
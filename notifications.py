@@ -0,0 +1,147 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from psycopg2 import extras
+import config
+from carriers import TokenBucket
+from instrumentation import TimedCursor, metrics
+
+
+# Email customers directly when their order is flagged; off unless enabled in config
+customer_notifications = getattr(config, 'customer_notifications', False)
+notification_categories = getattr(config, 'notification_categories', ('stuck', 'delay', 'alert'))
+notification_from_email = getattr(config, 'notification_from_email', config.from_email)
+
+# SendGrid accepts up to 1000 personalizations (one per customer here) in a single send
+personalizations_per_request = getattr(config, 'personalizations_per_request', 1000)
+notification_concurrency = getattr(config, 'notification_concurrency', 4)
+notification_rate = getattr(config, 'notification_rate', 5)  # sends per second
+
+# A claim still unsent after this long belongs to an invocation that died before recording the
+# send, and may be claimed again. Longer than a Lambda invocation can run.
+notification_claim_timeout_minutes = getattr(config, 'notification_claim_timeout_minutes', 20)
+
+# Per-category subject and HTML body. -customer_name-, -order_number- and -tracking_number-
+# are replaced per recipient by SendGrid, so one request covers a whole batch of customers.
+notification_templates = getattr(config, 'notification_templates', {
+    'stuck': (
+        "An update on your order #-order_number-",
+        "Hi -customer_name-,<br><br>Your order #-order_number- (tracking number -tracking_number-) hasn't moved "
+        "for a few days. We're looking into it with the carrier and will be in touch.<br>",
+    ),
+    'delay': (
+        "Your order #-order_number- is delayed",
+        "Hi -customer_name-,<br><br>The carrier has reported a delay on your order #-order_number- "
+        "(tracking number -tracking_number-). It's still on its way, just later than expected.<br>",
+    ),
+    'alert': (
+        "Action may be needed for your order #-order_number-",
+        "Hi -customer_name-,<br><br>The carrier has posted an alert on your order #-order_number- "
+        "(tracking number -tracking_number-). Please check the tracking page for details.<br>",
+    ),
+})
+
+
+class NotificationDispatcher:
+    def __init__(self, cnx, sendgrid, batch_size=personalizations_per_request, workers=notification_concurrency, rate=notification_rate):
+        self.cnx = cnx
+        self.sendgrid = sendgrid  # returns the SendGrid client, which is only built if something is sent
+        self.batch_size = batch_size
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.queued = {}  # (order number, status) -> (category, order)
+
+    def __len__(self):
+        return len(self.queued)
+
+    def add(self, category, status_entry, order):
+        # order is the report entry built by add_to_email
+        if category not in notification_categories or not order['customer_email']:
+            return
+        self.queued.setdefault((order['order_number'], status_entry), (category, order))
+
+    def claim(self, cursor):
+        # Returns the queued keys nobody has claimed yet, or whose claim went stale without a
+        # send being recorded, committing the claims before any send
+        if not self.queued:
+            return set()
+        claimed = extras.execute_values(
+            cursor,
+            'INSERT INTO customer_notifications ("OrderNumber", "Status", "Category", "CustomerEmail") VALUES %s '
+            'ON CONFLICT ("OrderNumber", "Status") DO UPDATE SET '
+            '"Category" = EXCLUDED."Category", "CustomerEmail" = EXCLUDED."CustomerEmail", "ClaimedAt" = now() '
+            'WHERE customer_notifications."SentAt" IS NULL '
+            f'AND customer_notifications."ClaimedAt" < now() - make_interval(mins => {int(notification_claim_timeout_minutes)}) '
+            'RETURNING "OrderNumber", "Status";',
+            [(order_number, status, category, order['customer_email']) for (order_number, status), (category, order) in self.queued.items()],
+            page_size=1000,
+            fetch=True
+        )
+        self.cnx.commit()
+        return {(order_number, status) for order_number, status in claimed}
+
+    def build_message(self, category, orders):
+        from sendgrid.helpers.mail import Mail, Personalization, Substitution, To
+
+        subject, html_content = notification_templates[category]
+        message = Mail(from_email=notification_from_email, subject=subject, html_content=html_content)
+        for order in orders:
+            personalization = Personalization()
+            personalization.add_to(To(order['customer_email']))
+            personalization.add_substitution(Substitution('-customer_name-', str(order['customer_name'] or '')))
+            personalization.add_substitution(Substitution('-order_number-', str(order['order_number'])))
+            personalization.add_substitution(Substitution('-tracking_number-', str(order['tracking_number'])))
+            message.add_personalization(personalization)
+        return message
+
+    def send_batch(self, sg, category, batch):
+        self.bucket.acquire()
+        with metrics.timer('notification_send'):
+            sg.send(self.build_message(category, [order for key, order in batch]))
+
+    def dispatch(self):
+        # Send every queued notification not already sent by an earlier run or attempt.
+        # Returns (sent, already sent, failed) counts.
+        cursor = self.cnx.cursor(cursor_factory=TimedCursor)
+        claimed = self.claim(cursor)
+        already_sent = len(self.queued) - len(claimed)
+
+        batches = []
+        by_category = {}
+        for key in claimed:
+            category, order = self.queued[key]
+            by_category.setdefault(category, []).append((key, order))
+        for category, entries in by_category.items():
+            for start in range(0, len(entries), self.batch_size):
+                batches.append((category, entries[start:start + self.batch_size]))
+
+        sent_keys, failed_keys = [], []
+        sg = self.sendgrid() if batches else None
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="notifications") as executor:
+            futures = {executor.submit(self.send_batch, sg, category, batch): batch for category, batch in batches}
+            for future, batch in futures.items():
+                keys = [key for key, order in batch]
+                try:
+                    future.result()
+                    sent_keys.extend(keys)
+                except Exception as e:
+                    print(f"Error sending {len(batch)} customer notifications: {e}")
+                    failed_keys.extend(keys)
+
+        # Failed claims are released so the next run retries them
+        if sent_keys:
+            cursor.execute(
+                'UPDATE customer_notifications SET "SentAt" = now() WHERE ("OrderNumber", "Status") IN (SELECT * FROM unnest(%s::text[], %s::text[]));',
+                ([order_number for order_number, status in sent_keys], [status for order_number, status in sent_keys])
+            )
+        if failed_keys:
+            cursor.execute(
+                'DELETE FROM customer_notifications WHERE ("OrderNumber", "Status") IN (SELECT * FROM unnest(%s::text[], %s::text[]));',
+                ([order_number for order_number, status in failed_keys], [status for order_number, status in failed_keys])
+            )
+        self.cnx.commit()
+        cursor.close()
+        self.queued.clear()
+
+        metrics.incr('notifications_sent', len(sent_keys))
+        metrics.incr('notifications_failed', len(failed_keys))
+        return len(sent_keys), already_sent, len(failed_keys)
@@ -0,0 +1,99 @@
+import datetime
+import hashlib
+import json
+
+import config
+from business_days import calendar
+
+
+# Hours to wait between polls of a shipment, by how likely its tracking is to have changed
+poll_intervals = getattr(config, 'poll_intervals', {
+    'exception': 1,  # alerts, problem and delay codes
+    'pre_shipment': 24,  # label created, not yet old enough for the 3-business-day stuck rule
+    'scheduled': 24,  # unchanged since the last poll with a delivery date more than 2 business days out
+    'default': 4,
+})
+
+# Runs don't start at exactly the same time each day, so a shipment is due slightly early
+poll_slack_hours = getattr(config, 'poll_slack_hours', 1)
+
+# Set to False to poll every open shipment on every run
+incremental_polling = getattr(config, 'incremental_polling', True)
+
+
+def parse_date(value):
+    # Carrier dates come as YYYYMMDD (UPS) or ISO 8601 (USPS)
+    if not value:
+        return None
+    value = str(value)
+    try:
+        if len(value) == 8 and value.isdigit():
+            return datetime.datetime.strptime(value, "%Y%m%d").date()
+        return datetime.date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+
+def response_summary(status):
+    # The handful of fields that identify the latest carrier event, keyed as they always have
+    # been so stored fingerprints stay comparable
+    if status.carrier == 'USPS':
+        return {
+            'status': status.category,
+            'detail': status.description,
+            'event_time': status.event_time,
+            'city': status.city,
+            'delivery_date': status.delivery_date,
+        }
+    return {
+        'status': status.code,
+        'event_time': status.event_time,
+        'city': status.city,
+        'delivery_date': status.delivery_date,
+    }
+
+
+def fingerprint(summary):
+    return hashlib.sha1(json.dumps(summary, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def poll_state(row, status, polled_at):
+    # Poll bookkeeping to store for a shipment after a successful carrier response
+    summary = response_summary(status)
+    response_fingerprint = fingerprint(summary)
+    unchanged_polls = (row['UnchangedPolls'] or 0) + 1 if response_fingerprint == row['Fingerprint'] else 0
+    return {
+        "LastPolled": polled_at,
+        "LastEventTime": summary['event_time'],
+        "ExpectedDelivery": parse_date(summary['delivery_date']),
+        "Fingerprint": response_fingerprint,
+        "UnchangedPolls": unchanged_polls,
+    }
+
+
+def is_exception(row):
+    status = row['StatusCode'] or ''
+    if row['CarrierName'] == 'USPS':
+        return status == 'Alert'
+    # UPS statuses are stored as "<code>: <description>"
+    code = status.split(':')[0]
+    return row['Delayed'] == 'Yes' or code in config.problem_codes_ups or code in config.delay_codes
+
+
+def poll_category(row, current_date):
+    status = row['StatusCode'] or ''
+    if is_exception(row):
+        return 'exception'
+    if (status == 'Pre-Shipment' or status.startswith('003')) and calendar.count(row['ShippedDate'], current_date) < 3:
+        return 'pre_shipment'
+    expected_delivery = row['ExpectedDelivery']
+    if expected_delivery and row['UnchangedPolls'] and calendar.count(current_date, expected_delivery) > 2:
+        return 'scheduled'
+    return 'default'
+
+
+def is_due(row, current_date):
+    if not incremental_polling or row['LastPolled'] is None:
+        return True
+    interval = poll_intervals[poll_category(row, current_date)]
+    return current_date - row['LastPolled'] >= datetime.timedelta(hours=interval - poll_slack_hours)
@@ -0,0 +1,145 @@
+import base64
+import csv
+import io
+
+import config
+
+
+# Orders listed inline in each section of the report email (problem orders, alerts, tracking
+# errors). Every flagged order is also in the attached CSV, so large runs can't push the
+# message past SendGrid's size limit.
+report_inline_rows = getattr(config, 'report_inline_rows', 250)
+
+CSV_COLUMNS = ("Category", "Code", "Order Number", "Tracking Number", "Ship Date", "Customer Name", "Customer Email")
+
+CELL = '<td style="border: 1px solid black; padding: 5px;">{}</td>'
+TABLE_HEADER = """
+<table style="width: 100%; border: 1px solid black;">
+    <tr><th colspan="6" style="font-size:18px;">{title}</th></tr>
+    <tr>
+        <th style="border: 1px solid black; padding: 5px;">{code_header}</th>
+        <th style="border: 1px solid black; padding: 5px;">Order Number</th>
+        <th style="border: 1px solid black; padding: 5px;">Tracking Number</th>
+        <th style="border: 1px solid black; padding: 5px;">Ship Date</th>
+        <th style="border: 1px solid black; padding: 5px;">Customer Name</th>
+        <th style="border: 1px solid black; padding: 5px;">Customer Email</th>
+    </tr>
+"""
+
+
+def code_label(code, stuck=False):
+    # Stuck codes carry a numeric prefix only used to pick the row colour
+    if 'Pre' not in code:
+        if stuck:
+            return code[5:]
+        if code[:3] == '003':
+            return "Status Stuck at 'Shipment Ready for UPS'"
+    return code
+
+
+def color_key(code, prefix_only=False):
+    if prefix_only or code[4:5] == ':':
+        return code[:3]
+    return code
+
+
+class ReportRenderer:
+    # Writes the report HTML into one buffer, so rendering stays linear in the number of
+    # flagged orders, and stops listing a section's orders once inline_rows have been written
+    def __init__(self, inline_rows=report_inline_rows):
+        self.out = io.StringIO()
+        self.inline_rows = inline_rows
+        self.remaining = inline_rows
+        self.omitted = 0
+
+    def start_section(self):
+        self.remaining = self.inline_rows
+
+    def take(self, items):
+        shown = items[:max(self.remaining, 0)]
+        self.remaining -= len(shown)
+        self.omitted += len(items) - len(shown)
+        return shown
+
+    def write_group(self, label, orders, bg_color):
+        orders = self.take(orders)
+        if not orders:
+            return
+        write = self.out.write
+        for i, order in enumerate(orders):
+            write(f'<tr style="background-color: {bg_color};">')
+            if i == 0:
+                write(f'<td rowspan="{len(orders)}" style="width: 20%; border: 1px solid black; padding: 5px;"><b>{label}</b></td>')
+            for key in ('order_number', 'tracking_number', 'shipped_date', 'customer_name', 'customer_email'):
+                write(CELL.format(order[key]))
+            write('</tr>\n')
+
+    def write_counts(self, counts):
+        self.out.write(f"""\
+<br><u><b>Processing Counts</b></u><br>
+# of Orders Processed: {counts['processed']}<br>
+# of Orders Delivered: {counts['delivered']}<br>
+# of Problem Orders: {counts['problem_orders']}<br>
+# of Orders with Tracking Errors: {counts['errors']}<br>
+# of Alerts: {counts['alerts']}<br><br>
+""")
+
+    def render(self, counts, stuck_orders, problem_orders, delay_orders, alert_orders, error_orders):
+        self.write_counts(counts)
+
+        self.start_section()
+        self.out.write(TABLE_HEADER.format(title="Problem Orders", code_header="Problem Code"))
+        # Stuck orders first, then non-delayed problem orders, then delayed ones
+        for code, orders in stuck_orders.items():
+            self.write_group(code_label(code, True), orders, config.email_color_codes.get(color_key(code), "#ffffff"))
+        for code, orders in problem_orders.items():
+            self.write_group(code_label(code), orders, config.email_color_codes.get(color_key(code), "#ffffff"))
+        for code, orders in delay_orders.items():
+            self.write_group(code_label(code), orders, config.email_color_codes.get(color_key(code, True), "#ffffff"))
+        self.out.write("</table>")
+
+        if alert_orders:
+            self.start_section()
+            self.out.write("<br><br>")
+            self.out.write(TABLE_HEADER.format(title="Alert Orders", code_header="Alert Code"))
+            for code, orders in alert_orders.items():
+                self.write_group(code_label(code), orders, config.email_color_codes.get(code, "#ffffff"))
+            self.out.write("</table>")
+
+        if error_orders:
+            self.start_section()
+            self.out.write("<br><br><u><b>Received error message when trying to track the following order(s):</b></u><br><ul>")
+            for order_number, customer, tracking in self.take(error_orders):
+                self.out.write(f"<li>#{order_number} {customer}: {tracking}</li>")
+            self.out.write("</ul>")
+
+        if self.omitted:
+            self.out.write(f"<br><b>{self.omitted} more order(s) not shown; the attached CSV lists every flagged order.</b>")
+        return self.out.getvalue()
+
+
+def render_report(counts, stuck_orders, problem_orders, delay_orders, alert_orders, error_orders, inline_rows=report_inline_rows):
+    return ReportRenderer(inline_rows).render(counts, stuck_orders, problem_orders, delay_orders, alert_orders, error_orders)
+
+
+def csv_attachment(order_data, error_orders, filename="flagged_orders.csv"):
+    # order_data maps a category name to its {code: [orders]} dict. Returns None if nothing was flagged.
+    if not error_orders and not any(order_data.values()):
+        return None
+    from sendgrid.helpers.mail import Attachment, Disposition, FileContent, FileName, FileType
+
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    for category, orders_by_code in order_data.items():
+        for code, orders in orders_by_code.items():
+            for order in orders:
+                writer.writerow((category, code, order['order_number'], order['tracking_number'], order['shipped_date'], order['customer_name'], order['customer_email']))
+    for order_number, customer, tracking in error_orders:
+        writer.writerow(("tracking error", "", order_number, tracking, "", customer, ""))
+    return Attachment(
+        FileContent(base64.b64encode(out.getvalue().encode()).decode()),
+        FileName(filename),
+        FileType("text/csv"),
+        Disposition("attachment")
+    )
@@ -0,0 +1,168 @@
+import datetime
+import json
+import uuid
+
+import checkpoints
+import config
+from carriers import adapters
+
+
+# Scheduled runs fan out to this many worker invocations; 1 keeps the single-invocation pass
+shard_count = getattr(config, 'shard_count', 1)
+
+# 'hash' splits open shipments by a hash of OrderNumber, 'carrier' gives each worker whole carriers
+shard_partition = getattr(config, 'shard_partition', 'hash')
+
+# 'lambda' invokes workers asynchronously through the Lambda API; 'local' runs each worker in a
+# child process and waits for them, for testing against a local database
+shard_invoker = getattr(config, 'shard_invoker', 'lambda')
+worker_function_name = getattr(config, 'worker_function_name', None)
+
+# Shipments a worker claims (and keeps locked) per transaction
+shard_page_size = getattr(config, 'shard_page_size', 500)
+
+# A sharded run still unreported this long after it started has lost a worker; the next
+# coordinator reports on whatever its shards checkpointed
+shard_report_timeout_hours = getattr(config, 'shard_report_timeout_hours', 3)
+
+# Key class of the advisory locks that keep two invocations from working the same shard
+SHARD_LOCK = 7261018
+
+
+def start_run(cursor, current_date, report_subject, count=None, partition=None):
+    # Registers a sharded run and returns the events for its workers
+    count = count or shard_count
+    partition = partition or shard_partition
+    if partition not in ('hash', 'carrier'):
+        raise ValueError(f"Unknown shard partition {partition!r}")
+    if partition == 'carrier':
+        count = min(count, len(adapters))
+    run_id = uuid.uuid4().hex
+    cursor.execute(
+        'INSERT INTO sharded_runs ("RunId", "StartedAt", "ShardCount", "Partition", "ReportSubject") VALUES (%s, %s, %s, %s, %s);',
+        (run_id, current_date, count, partition, report_subject)
+    )
+    return [
+        {'shard': {'run_id': run_id, 'index': index, 'count': count, 'partition': partition, 'report_subject': report_subject}}
+        for index in range(count)
+    ]
+
+
+def shard_filter(shard):
+    # SQL condition on the shipments alias s selecting one shard's rows, and its parameters
+    if shard['partition'] == 'carrier':
+        carrier_names = [carrier for i, carrier in enumerate(sorted(adapters)) if i % shard['count'] == shard['index']]
+        return "s.\"CarrierName\" = ANY(%s)", (carrier_names,)
+    return "abs(hashtext(s.\"OrderNumber\")::bigint) %% %s = %s", (shard['count'], shard['index'])
+
+
+def shard_run_id(shard):
+    return f"{shard['run_id']}:{shard['index']}"
+
+
+def lock_shard(cursor, shard):
+    # Session-level, so the lock outlives the worker's page commits. Released by unlock_shard, or
+    # with the connection if the worker dies; returns False if another invocation holds it.
+    cursor.execute("SELECT pg_try_advisory_lock(%s, hashtext(%s));", (SHARD_LOCK, shard_run_id(shard)))
+    return cursor.fetchone()[0]
+
+
+def unlock_shard(cursor, shard):
+    cursor.execute("SELECT pg_advisory_unlock(%s, hashtext(%s));", (SHARD_LOCK, shard_run_id(shard)))
+
+
+def run_local_worker(event):
+    import carriers
+    from tracking_notifier import lambda_handler
+
+    carriers.reset_sessions()
+    lambda_handler(event, None)
+
+
+def invoke_workers(events, context=None):
+    if shard_invoker == 'local':
+        import multiprocessing
+
+        # Forked so workers share this process's configuration, including anything patched for a test
+        processes = [multiprocessing.get_context('fork').Process(target=run_local_worker, args=(event,)) for event in events]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+        return
+
+    import boto3
+
+    function_name = worker_function_name or context.function_name
+    client = boto3.client('lambda')
+    for event in events:
+        client.invoke(FunctionName=function_name, InvocationType='Event', Payload=json.dumps(event).encode())
+
+
+def merge_aggregates(shard_aggregates):
+    # Combine the report aggregates checkpointed by each worker into those of a single run
+    merged = {'error_orders': [], 'order_data': {}}
+    for aggregates in shard_aggregates:
+        for key, value in aggregates.items():
+            if key == 'error_orders':
+                merged['error_orders'].extend(value)
+            elif key == 'order_data':
+                for category, orders_by_code in value.items():
+                    merged_codes = merged['order_data'].setdefault(category, {})
+                    for code, orders in orders_by_code.items():
+                        merged_codes.setdefault(code, []).extend(orders)
+            elif isinstance(value, int):
+                merged[key] = merged.get(key, 0) + value
+            else:
+                merged.setdefault(key, value)
+    return merged
+
+
+def shard_aggregates(cursor, run_id, completed_only=True):
+    # The checkpointed aggregates of a sharded run's workers, with their flagged orders loaded
+    where = '"ParentRunId" = %s AND "Completed"' if completed_only else '"ParentRunId" = %s'
+    cursor.execute(f'SELECT "RunId", "Aggregates" FROM run_checkpoints WHERE {where};', (run_id,))
+    shard_checkpoints = cursor.fetchall()
+    flagged = checkpoints.load_flagged_orders(cursor, [shard_run for shard_run, aggregates in shard_checkpoints])
+    for shard_run, aggregates in shard_checkpoints:
+        aggregates['order_data'], aggregates['error_orders'] = flagged[shard_run]
+    return {shard_run: aggregates for shard_run, aggregates in shard_checkpoints}
+
+
+def finish_shard(cursor, shard):
+    # Called by each worker after committing its final checkpoint. The worker that completes the
+    # set gets the merged aggregates back and sends the report; every other worker gets None.
+    # Locking the run row makes sure exactly one worker sees the set complete.
+    cursor.execute('SELECT "ShardCount", "ReportSent" FROM sharded_runs WHERE "RunId" = %s FOR UPDATE;', (shard['run_id'],))
+    count, report_sent = cursor.fetchone()
+    if report_sent:
+        # Already reported without this shard by overdue_runs
+        checkpoints.delete_flagged_orders(cursor, [shard_run_id(shard)])
+        return None
+    cursor.execute('SELECT count(*) FROM run_checkpoints WHERE "ParentRunId" = %s AND "Completed";', (shard['run_id'],))
+    if cursor.fetchone()[0] < count:
+        return None
+    shards = shard_aggregates(cursor, shard['run_id'])
+    checkpoints.delete_flagged_orders(cursor, list(shards))
+    cursor.execute('UPDATE sharded_runs SET "ReportSent" = true WHERE "RunId" = %s;', (shard['run_id'],))
+    return merge_aggregates(shards.values())
+
+
+def overdue_runs(cursor, current_date):
+    # Claim the sharded runs that should long since have been reported because a worker failed
+    # for good. Returns (subject, merged aggregates) for each, covering the shards' progress so
+    # far; the caller sends the reports and commits. Runs another coordinator is handling are skipped.
+    cursor.execute(
+        'SELECT "RunId", "ShardCount", "ReportSubject" FROM sharded_runs WHERE NOT "ReportSent" AND "StartedAt" < %s '
+        'ORDER BY "StartedAt" FOR UPDATE SKIP LOCKED;',
+        (current_date - datetime.timedelta(hours=shard_report_timeout_hours),)
+    )
+    reports = []
+    for run_id, count, subject in cursor.fetchall():
+        cursor.execute('SELECT count(*) FROM run_checkpoints WHERE "ParentRunId" = %s AND "Completed";', (run_id,))
+        finished = cursor.fetchone()[0]
+        shards = shard_aggregates(cursor, run_id, completed_only=False)
+        checkpoints.delete_flagged_orders(cursor, list(shards))
+        cursor.execute('UPDATE sharded_runs SET "ReportSent" = true WHERE "RunId" = %s;', (run_id,))
+        reports.append((f"{subject} (incomplete: {finished} of {count} shards finished)", merge_aggregates(shards.values())))
+    return reports
@@ -0,0 +1,300 @@
+import time
+
+from psycopg2 import errors, extras, Error
+import config
+from instrumentation import TimedCursor, metrics
+
+
+# Number of buffered orders after which pending writes are flushed mid-pass
+write_batch_size = getattr(config, 'write_batch_size', 500)
+
+# Rows fetched per round-trip by the server-side shipment scan
+scan_itersize = getattr(config, 'scan_itersize', 1000)
+
+# Times a shard page is re-claimed when a webhook or ingest holds one of its rows, and the pause
+# between tries, before the worker waits for the lock instead
+claim_lock_retries = getattr(config, 'claim_lock_retries', 3)
+claim_lock_retry_seconds = getattr(config, 'claim_lock_retry_seconds', 0.2)
+
+# Columns the tracking pass reads; the product quantity columns are never needed
+TRACKED_COLUMNS = (
+    "OrderNumber", "CustomerName", "CustomerEmail", "TrackingNumber", "CarrierName", "ShippedDate",
+    "StatusCode", "LastLocation", "LastLocationDate", "NotificationSent", "Delayed"
+)
+
+
+# Per-order polling bookkeeping used by polling_schedule, kept out of shipments so rows can
+# still be copied column-for-column into delivered and problem_orders
+POLL_COLUMNS = ("LastPolled", "LastEventTime", "ExpectedDelivery", "Fingerprint", "UnchangedPolls")
+
+
+def scan_query(where=""):
+    column_names = ", ".join([f"s.\"{column}\"" for column in TRACKED_COLUMNS] + [f"p.\"{column}\"" for column in POLL_COLUMNS])
+    return f"SELECT {column_names} FROM shipments s LEFT JOIN shipment_poll_state p ON p.\"OrderNumber\" = s.\"OrderNumber\" {where};"
+
+
+def stream_shipments(cnx, after=None):
+    # Server-side cursor: rows arrive scan_itersize at a time, so memory stays bounded however
+    # large the shipments table is. Rows come in OrderNumber order so a run can resume after
+    # the last order it checkpointed, and the cursor is held open across the mid-run commits.
+    cursor = cnx.cursor(name="shipment_scan", cursor_factory=TimedCursor, withhold=True)
+    try:
+        if after is None:
+            cursor.execute(scan_query("ORDER BY s.\"OrderNumber\""))
+        else:
+            cursor.execute(scan_query("WHERE s.\"OrderNumber\" > %s ORDER BY s.\"OrderNumber\""), (after,))
+        # fetchmany rather than iterating, so TimedCursor counts each FETCH
+        while True:
+            rows = cursor.fetchmany(scan_itersize)
+            if not rows:
+                break
+            yield from rows
+    finally:
+        cursor.close()
+
+
+def claim_shipments(cursor, after, shard_condition, shard_params, limit):
+    # Lock and return the next page of a shard's shipments after the given order number; the
+    # locks last until the worker commits the page. Locked rows can't be skipped, as the
+    # checkpoint moves past the whole page; their holder is a short webhook or ingest
+    # transaction, so the claim is retried a few times before it waits for the lock.
+    where = f"WHERE {shard_condition}"
+    params = tuple(shard_params)
+    if after is not None:
+        where += " AND s.\"OrderNumber\" > %s"
+        params += (after,)
+    claim = f"{where} ORDER BY s.\"OrderNumber\" LIMIT %s FOR UPDATE OF s"
+    for attempt in range(claim_lock_retries):
+        try:
+            cursor.execute("SAVEPOINT claim_page;")
+            cursor.execute(scan_query(f"{claim} NOWAIT"), params + (limit,))
+            rows = cursor.fetchall()
+            cursor.execute("RELEASE SAVEPOINT claim_page;")
+            return rows
+        except errors.LockNotAvailable:
+            cursor.execute("ROLLBACK TO SAVEPOINT claim_page;")
+            metrics.incr('claim_lock_retries')
+            time.sleep(claim_lock_retry_seconds)
+    print(f"Shipments after order {after} are still locked after {claim_lock_retries} tries; waiting for them")
+    cursor.execute(scan_query(claim), params + (limit,))
+    return cursor.fetchall()
+
+
+def fetch_shipments_by_tracking(cursor, tracking_numbers):
+    cursor.execute(scan_query("WHERE s.\"TrackingNumber\" = ANY(%s)"), (list(tracking_numbers),))
+    return cursor.fetchall()
+
+
+class WriteBuffer:
+    # Collects per-order column updates and table moves during the tracking pass and
+    # flushes them as a handful of set-based statements instead of several per order.
+    def __init__(self, cursor, table="shipments", history=None):
+        self.cursor = cursor
+        self.table = table
+        self.history = history  # event_history.EventHistory appended to on every flush, if kept
+        self.updates = {}  # order number -> {column: value}
+        self.moves = {}  # order number -> target table
+        self.polls = {}  # order number -> poll state
+
+    def __len__(self):
+        return len(self.updates.keys() | self.moves.keys() | self.polls.keys())
+
+    def update(self, order_number, update_values):
+        if order_number in self.moves:
+            # Updates issued after a move used to hit a row that was already deleted
+            return
+        self.updates.setdefault(order_number, {}).update(update_values)
+
+    def move(self, order_number, target_table, notification_update=False):
+        if notification_update:
+            self.update(order_number, {"NotificationSent": 'Yes'})
+        self.moves.setdefault(order_number, target_table)
+
+    def record_poll(self, order_number, state):
+        self.polls[order_number] = state
+
+    def pending(self, order_number):
+        # Column values buffered for an order but not yet written
+        return self.updates.get(order_number, {})
+
+    def flush(self):
+        # Updates go first so moved rows carry them into the target table
+        self.flush_updates()
+        self.flush_polls()
+        self.flush_moves()
+        if self.history is not None:
+            self.history.flush(self.cursor)
+        self.updates.clear()
+        self.moves.clear()
+        self.polls.clear()
+
+    def flush_updates(self):
+        groups = {}
+        for order_number, update_values in self.updates.items():
+            columns = tuple(sorted(update_values))
+            groups.setdefault(columns, []).append((order_number, *[update_values[column] for column in columns]))
+
+        for columns, rows in groups.items():
+            column_names = ", ".join([f"\"{column}\"" for column in columns])
+            set_clause = ", ".join([f"\"{column}\"=u.\"{column}\"" for column in columns])
+            try:
+                self.cursor.execute("SAVEPOINT write_buffer;")
+                # Copy the column types from the target table so values are cast exactly as a direct UPDATE would
+                self.cursor.execute(f"CREATE TEMP TABLE shipment_updates AS SELECT \"OrderNumber\", {column_names} FROM {self.table} WITH NO DATA;")
+                extras.execute_values(self.cursor, "INSERT INTO shipment_updates VALUES %s;", rows, page_size=1000)
+                self.cursor.execute(f"UPDATE {self.table} SET {set_clause} FROM shipment_updates u WHERE {self.table}.\"OrderNumber\"=u.\"OrderNumber\";")
+                self.cursor.execute("DROP TABLE shipment_updates;")
+                self.cursor.execute("RELEASE SAVEPOINT write_buffer;")
+            except Error as e:
+                print(f"Batched update of {column_names} failed, retrying order by order: {e}")
+                self.cursor.execute("ROLLBACK TO SAVEPOINT write_buffer;")
+                self.update_individually(columns, rows)
+
+    def update_individually(self, columns, rows):
+        set_clause = ", ".join([f"\"{column}\"=%s" for column in columns])
+        update_query = f"UPDATE {self.table} SET {set_clause} WHERE \"OrderNumber\"=%s;"
+        for order_number, *values in rows:
+            try:
+                self.cursor.execute("SAVEPOINT write_buffer;")
+                self.cursor.execute(update_query, (*values, order_number))
+                self.cursor.execute("RELEASE SAVEPOINT write_buffer;")
+            except Error as e:
+                print(f"Database error occurred while updating columns for order {order_number}: {e}")
+                self.cursor.execute("ROLLBACK TO SAVEPOINT write_buffer;")
+
+    def flush_polls(self):
+        # Orders leaving shipments don't need poll state any more
+        rows = [
+            (order_number, *[state[column] for column in POLL_COLUMNS])
+            for order_number, state in self.polls.items() if order_number not in self.moves
+        ]
+        if not rows:
+            return
+        column_names = ", ".join([f"\"{column}\"" for column in POLL_COLUMNS])
+        set_clause = ", ".join([f"\"{column}\"=EXCLUDED.\"{column}\"" for column in POLL_COLUMNS])
+        try:
+            self.cursor.execute("SAVEPOINT write_buffer;")
+            extras.execute_values(
+                self.cursor,
+                f"INSERT INTO shipment_poll_state (\"OrderNumber\", {column_names}) VALUES %s ON CONFLICT (\"OrderNumber\") DO UPDATE SET {set_clause};",
+                rows,
+                page_size=1000
+            )
+            self.cursor.execute("RELEASE SAVEPOINT write_buffer;")
+        except Error as e:
+            # Losing poll state only means these orders are polled again next run
+            print(f"Error saving poll state for {len(rows)} orders: {e}")
+            self.cursor.execute("ROLLBACK TO SAVEPOINT write_buffer;")
+
+    def flush_moves(self):
+        targets = {}
+        for order_number, target_table in self.moves.items():
+            targets.setdefault(target_table, []).append(order_number)
+
+        for target_table, order_numbers in targets.items():
+            try:
+                self.cursor.execute("SAVEPOINT write_buffer;")
+                self.cursor.execute(f"INSERT INTO {target_table} SELECT * FROM {self.table} WHERE \"OrderNumber\" = ANY(%s);", (order_numbers,))
+                self.cursor.execute(f"DELETE FROM {self.table} WHERE \"OrderNumber\" = ANY(%s);", (order_numbers,))
+                self.cursor.execute("DELETE FROM shipment_poll_state WHERE \"OrderNumber\" = ANY(%s);", (order_numbers,))
+                self.cursor.execute("RELEASE SAVEPOINT write_buffer;")
+            except Error as e:
+                print(f"Batched move of {len(order_numbers)} orders to {target_table} failed, retrying order by order: {e}")
+                self.cursor.execute("ROLLBACK TO SAVEPOINT write_buffer;")
+                for order_number in order_numbers:
+                    self.move_individually(order_number, target_table)
+
+    def move_individually(self, order_number, target_table):
+        try:
+            self.cursor.execute("SAVEPOINT write_buffer;")
+            self.cursor.execute(f"INSERT INTO {target_table} SELECT * FROM {self.table} WHERE \"OrderNumber\"=%s;", (order_number,))
+            self.cursor.execute(f"DELETE FROM {self.table} WHERE \"OrderNumber\"=%s;", (order_number,))
+            self.cursor.execute("DELETE FROM shipment_poll_state WHERE \"OrderNumber\"=%s;", (order_number,))
+            self.cursor.execute("RELEASE SAVEPOINT write_buffer;")
+        except Error as e:
+            print(f"Error moving order {order_number} to {target_table}: {e}")
+            self.cursor.execute("ROLLBACK TO SAVEPOINT write_buffer;")
+
+
+# Columns written by the database_entries ingestion event. Product quantity columns default to 0.
+ENTRY_COLUMNS = (
+    "OrderNumber", "CustomerName", "CustomerEmail", "TrackingNumber", "CarrierName", "ShippedDate", "StatusCode", "LastLocation",
+    "DaysAtLastLocation", "NotificationSent", "Delayed", "Delivered"
+)
+PRODUCT_COLUMNS = (
+    "STK", "A1GG", "A1LLF", "GreenGlow", "IronStrength", "LiquidLush", "MightyMicros",
+    "SoilBalance", "TurfTonic", "MosquitoDefense", "LawnGuard", "LoneStarLawnFood",
+    "WeedWizardBottle", "Sprayer", "LawnGuardSprayer", "WandSprayer"
+)
+INGEST_COLUMNS = ENTRY_COLUMNS + PRODUCT_COLUMNS
+
+# Number of entries staged and upserted per statement batch (and per commit)
+ingest_chunk_size = getattr(config, 'ingest_chunk_size', 1000)
+
+
+def entry_values(entry):
+    return tuple(entry[column] for column in ENTRY_COLUMNS) + tuple(entry.get(column, 0) for column in PRODUCT_COLUMNS)
+
+
+def upsert_query(source):
+    # Orders that were inserted or got a new tracking number lose any poll state, which
+    # described the old tracking number's responses
+    column_names = ", ".join([f"\"{column}\"" for column in INGEST_COLUMNS])
+    set_clause = ",\n                ".join([f"\"{column}\" = EXCLUDED.\"{column}\"" for column in INGEST_COLUMNS[1:]])
+    return f'''
+        WITH upserted AS (
+            INSERT INTO "shipments" ({column_names})
+            {source}
+            ON CONFLICT ("OrderNumber") DO UPDATE
+            SET
+                {set_clause}
+            WHERE "shipments"."TrackingNumber" != EXCLUDED."TrackingNumber"
+            RETURNING "OrderNumber"
+        )
+        DELETE FROM shipment_poll_state WHERE "OrderNumber" IN (SELECT "OrderNumber" FROM upserted);
+    '''
+
+
+def upsert_shipments(cnx, entries):
+    # Stage each chunk with execute_values and apply it with one set-based upsert. A chunk that
+    # fails is retried row by row under savepoints so only the bad entries are rejected.
+    # Returns a list of (order number, error message) for the entries that could not be written.
+    failures = []
+    rows = {}
+    for entry in entries:
+        try:
+            # Later entries for the same order win, as they did when each entry was upserted in turn
+            rows[entry['OrderNumber']] = entry_values(entry)
+        except (KeyError, TypeError) as e:
+            failures.append((entry.get('OrderNumber') if isinstance(entry, dict) else None, f"Malformed entry, missing {e}"))
+    rows = list(rows.values())
+
+    column_names = ", ".join([f"\"{column}\"" for column in INGEST_COLUMNS])
+    staged_upsert = upsert_query(f"SELECT {column_names} FROM shipment_staging")
+    single_upsert = upsert_query(f"VALUES ({', '.join(['%s'] * len(INGEST_COLUMNS))})")
+
+    cursor = cnx.cursor(cursor_factory=TimedCursor)
+    for start in range(0, len(rows), ingest_chunk_size):
+        chunk = rows[start:start + ingest_chunk_size]
+        try:
+            cursor.execute("SAVEPOINT ingest_chunk;")
+            cursor.execute(f"CREATE TEMP TABLE shipment_staging AS SELECT {column_names} FROM shipments WITH NO DATA;")
+            extras.execute_values(cursor, "INSERT INTO shipment_staging VALUES %s;", chunk, page_size=ingest_chunk_size)
+            cursor.execute(staged_upsert)
+            cursor.execute("DROP TABLE shipment_staging;")
+            cursor.execute("RELEASE SAVEPOINT ingest_chunk;")
+        except Error as e:
+            print(f"Bulk upsert of entries {start + 1}-{start + len(chunk)} failed, retrying row by row: {e}")
+            cursor.execute("ROLLBACK TO SAVEPOINT ingest_chunk;")
+            for data in chunk:
+                try:
+                    cursor.execute("SAVEPOINT ingest_row;")
+                    cursor.execute(single_upsert, data)
+                    cursor.execute("RELEASE SAVEPOINT ingest_row;")
+                except Error as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT ingest_row;")
+                    failures.append((data[0], str(e).strip()))
+        cnx.commit()
+        print(f"Upserted entries {start + 1}-{start + len(chunk)} of {len(rows)}")
+    cursor.close()
+    return failures
@@ -0,0 +1,104 @@
+import datetime
+
+import pytest
+
+import classification
+from carrier_recordings import builtin_recordings
+from classification import PROBLEM, STUCK, classify
+from tracking_status import parse
+
+
+# A Wednesday clear of holidays, so business-day counts don't depend on when the tests run
+TODAY = datetime.datetime(2024, 3, 13, 9, 0)
+RECORDINGS = builtin_recordings(TODAY.date())
+
+# Shipped a week ago and last seen in Louisville on the ship date
+STATE = {
+    "OrderNumber": "1001",
+    "ShippedDate": datetime.date(2024, 3, 6),
+    "StatusCode": None,
+    "LastLocation": "LOUISVILLE",
+    "LastLocationDate": datetime.date(2024, 3, 6),
+    "NotificationSent": "No",
+    "Delayed": "No",
+}
+
+MOVED = '20240312'  # activity date of the recordings
+
+# (carrier, recording index, state changes, expected actions)
+REPLAYS = [
+    ('UPS', 0, {}, [
+        ("update", {"StatusCode": "005: On the Way"}),
+        ("update", {"DaysAtLastLocation": 6}),
+    ]),
+    ('UPS', 1, {}, [
+        ("update", {"StatusCode": "005: On the Way"}),
+        ("update", {"LastLocation": "RENO", "LastLocationDate": MOVED, "DaysAtLastLocation": 2}),
+    ]),
+    ('UPS', 1, {"LastLocation": "RENO"}, [
+        ("update", {"StatusCode": "005: On the Way"}),
+        ("update", {"DaysAtLastLocation": 6}),
+        ("email", STUCK, "999: 5 Business Days without a Location Update, and No Delivery Date Found"),
+        ("move", "problem_orders", True),
+    ]),
+    ('UPS', 2, {}, [
+        ("update", {"StatusCode": "011: Delivered"}),
+        ("update", {"LastLocation": "AUSTIN", "LastLocationDate": MOVED, "DaysAtLastLocation": 2}),
+        ("update", {"Delivered": "Yes"}),
+        ("move", "delivered", False),
+    ]),
+    ('UPS', 3, {}, [
+        ("update", {"StatusCode": "003: Shipment Ready for UPS"}),
+        ("update", {"LastLocation": "DALLAS", "LastLocationDate": MOVED, "DaysAtLastLocation": 2}),
+        ("email", PROBLEM, "003: Shipment Ready for UPS"),
+        ("move", "problem_orders", True),
+    ]),
+    ('UPS', 4, {}, [
+        ("update", {"StatusCode": "X: Exception"}),
+        ("update", {"LastLocation": "DENVER", "LastLocationDate": MOVED, "DaysAtLastLocation": 2}),
+        ("email", PROBLEM, "X: Exception"),
+        ("move", "problem_orders", True),
+    ]),
+    ('USPS', 0, {}, [
+        ("update", {"StatusCode": "In Transit", "LastLocation": "MEMPHIS"}),
+    ]),
+    ('USPS', 1, {}, [
+        ("update", {"StatusCode": "Delivered", "LastLocation": "AUSTIN"}),
+        ("update", {"Delivered": "Yes"}),
+        ("move", "delivered", False),
+    ]),
+    ('USPS', 2, {}, [
+        ("update", {"StatusCode": "Pre-Shipment", "LastLocation": "DALLAS"}),
+    ]),
+    ('USPS', 2, {"StatusCode": "Pre-Shipment"}, [
+        ("update", {"StatusCode": "Pre-Shipment", "LastLocation": "DALLAS"}),
+        ("move", "problem_orders", True),
+        ("email", STUCK, "Status Stuck at 'Pre-Shipment' for 3 or More Business Days"),
+        ("update", {"DaysAtLastLocation": 6}),
+    ]),
+    ('USPS', 3, {}, [
+        ("update", {"StatusCode": "Alert", "LastLocation": "DENVER"}),
+        ("move", "problem_orders", True),
+        ("email", PROBLEM, "Delivery Attempted - No Access to Delivery Location"),
+    ]),
+]
+
+
+@pytest.fixture(autouse=True)
+def status_codes(monkeypatch):
+    # The deployed config's code lists, pinned so the expected actions don't follow config edits
+    monkeypatch.setattr(classification.config, 'delivered_codes', ['011'], raising=False)
+    monkeypatch.setattr(classification.config, 'problem_codes_ups', ['X'], raising=False)
+    monkeypatch.setattr(classification.config, 'delay_codes', [], raising=False)
+    monkeypatch.setattr(classification.config, 'problem_codes_usps', ['Delivery Attempted - No Access to Delivery Location'], raising=False)
+
+
+@pytest.mark.parametrize('carrier, index, changes, expected', REPLAYS)
+def test_replay_recordings(carrier, index, changes, expected):
+    status = parse(carrier, RECORDINGS[carrier][index])
+    assert classify({**STATE, **changes}, status, TODAY) == expected
+
+
+def test_every_recording_replayed():
+    replayed = {(carrier, index) for carrier, index, changes, expected in REPLAYS}
+    assert replayed == {(carrier, index) for carrier, recordings in RECORDINGS.items() for index in range(len(recordings))}
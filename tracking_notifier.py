@@ -1,53 +1,108 @@
-import csv
 import datetime
 import json
 import traceback
-import mysql.connector
-import numpy as np
-import requests
 from dateutil import tz
-from psycopg2 import extras, connect, Error, ProgrammingError, OperationalError
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail
+from psycopg2 import connect, Error
 import config
+import carriers
+import checkpoints
+from instrumentation import TimedCursor, debug, metrics
+import classification
+import event_history
+import migrations
+import notifications
+import polling_schedule
+import report
+import sharding
+import shipment_store
+from tracking_status import NoTrackingData
 
 
 # Get Pacific timezone object
 tz_us_pacific = tz.gettz('US/Pacific')
 
-now = datetime.datetime.now(tz_us_pacific)
+# Keep the database connection open between warm invocations of the same container
+reuse_connection = getattr(config, 'reuse_connection', True)
+warm_connection = None
+
+
+def get_connection():
+    # Reuse the warm connection if it still answers, otherwise open a new one
+    global warm_connection
+    if reuse_connection and warm_connection is not None and not warm_connection.closed:
+        try:
+            # A failed earlier invocation may have left a transaction open, or a shard lock held
+            warm_connection.rollback()
+            with warm_connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_unlock_all();")
+            warm_connection.rollback()
+            metrics.incr('db_connection_reused')
+            return warm_connection
+        except Error as e:
+            print(f"Reconnecting to the database after a failed health check: {e}")
+            discard_connection()
+
+    with metrics.timer('db_connect'):
+        warm_connection = connect(
+            dbname=config.dbname, 
+            user=config.user, 
+            password=config.pw, 
+            host=config.host, 
+            port=config.port
+        )
+    return warm_connection
+
+
+def release_connection(cnx):
+    # End of an invocation: close the connection, or just end its transaction if it is reused
+    if not reuse_connection:
+        cnx.close()
+    elif not cnx.closed:
+        cnx.rollback()
+
+
+def discard_connection():
+    global warm_connection
+    if warm_connection is not None and not warm_connection.closed:
+        try:
+            warm_connection.close()
+        except Error:
+            pass
+    warm_connection = None
+
+
+def sendgrid_client():
+    # Imported on first use, so invocations that send no email never load SendGrid
+    from sendgrid import SendGridAPIClient
+
+    # sendgrid_host can point at a local mock endpoint for testing
+    return SendGridAPIClient(config.ALCHEMIST_SENDGRID_API_KEY, host=getattr(config, 'sendgrid_host', 'https://api.sendgrid.com'))
 
-# Determine whether it's morning or afternoon
-if now.hour < 12:
-    time_of_day = "Morning"
-else:
-    time_of_day = "Afternoon"
 
 def lambda_handler(event, context):
-    cnx = connect(
-        dbname=config.dbname, 
-        user=config.user, 
-        password=config.pw, 
-        host=config.host, 
-        port=config.port
-    )
-    cursor = cnx.cursor(cursor_factory=extras.DictCursor)
-
-    # SendGrid setup
-    sg = SendGridAPIClient(config.ALCHEMIST_SENDGRID_API_KEY)
-
-    # Select data from database
-    query = "SELECT * FROM shipments"
-    cursor.execute(query)
+    # Timings and counters are per invocation, even when the container is reused
+    metrics.reset()
+    # A carrier that refused a token last invocation is tried again
+    carriers.token_manager.clear_failures()
+
+    cnx = get_connection()
+    cursor = cnx.cursor(cursor_factory=TimedCursor)
+
+    sg = None
+
+    def sendgrid():
+        nonlocal sg
+        if sg is None:
+            sg = sendgrid_client()
+        return sg
+
     problem_order_data = {}
     delay_order_data = {}
     stuck_order_data = {}
     alert_order_data = {}
-    count_query = "SELECT COUNT(*) FROM shipments;"
-    cursor.execute(count_query)
-    total_shipments = cursor.fetchone()[0]
-    cursor.execute(query)
+    total_shipments = 0
     processed_shipments = 0
+    skipped_shipments = 0
     problem_orders = 0
     errors = 0
     error_orders = []
@@ -55,104 +110,6 @@ def lambda_handler(event, context):
     alerts = 0
 
 
-    def calculate_days(date1, date2):
-        if isinstance(date1, str):
-            date1 = datetime.datetime.strptime(date1, "%Y%m%d").date()
-
-        start = date1
-        end = date2.date()
-        step = datetime.timedelta(days=1)
-        count = 0
-        while start <= end:
-            if start not in config.us_holidays_2023.keys() and start.weekday() < 5:
-                count += 1
-            start += step
-        return count
-
-    def get_ups_token():
-        oauth_url = "https://onlinetools.ups.com/security/v1/oauth/token"
-        payload = {
-            "grant_type": "client_credentials"
-        }
-        headers = {
-            "Content-Type": "application/x-www-form-urlencoded"
-        }
-        response = requests.post(oauth_url, data=payload, headers=headers, auth=(config.UPS_CLIENT_ID, config.UPS_CLIENT_SECRET))
-        if response.status_code != 200:
-            print("Error occurred: ", response.text)  # Print the error message
-            response.raise_for_status()  # This will raise an exception if the request failed
-        data = response.json()
-        return str(data["access_token"])
-
-    def get_usps_access_token():
-        oauth_url = "https://api.usps.com/oauth2/v3/token"
-        headers = {
-            'Content-Type': 'application/json',
-        }
-        data = {
-            'client_id': config.USPS_CLIENT_ID,
-            'client_secret': config.USPS_CLIENT_SECRET,
-            'grant_type': 'client_credentials',
-            'customer_registration_id': config.USPS_CUSTOMER_REGISTRATION_ID,
-            "mailer_id": config.USPS_MAILER_ID,
-        }
-
-        response = requests.post(oauth_url, headers=headers, json=data)  # Using json=data
-
-        if response.status_code == 200:
-            response_json = response.json()
-            return response_json['access_token']
-        else:
-            print(f"Request failed with status code: {response.status_code}")
-            return None
-
-    def move_row(cursor, order_number, source_table, target_table, notification_update=False):
-        # Optional notification update
-        if notification_update:
-            try:
-                notification_update_query = f"UPDATE {source_table} SET \"NotificationSent\"='Yes' WHERE \"OrderNumber\"=%s;"
-                cursor.execute(notification_update_query, (order_number,))
-            except Error as e:
-                print(f"Error updating notification status for order {order_number}: {e}")
-
-        # Copy row from source_table to target_table
-        try:
-            move_query = f"INSERT INTO {target_table} SELECT * FROM {source_table} WHERE \"OrderNumber\"=%s;"
-            cursor.execute(move_query, (order_number,))
-        except Error as e:
-            print(f"Error moving order {order_number} to {target_table}: {e}")
-
-        # Delete row from source_table
-        try:
-            delete_query = f"DELETE FROM {source_table} WHERE \"OrderNumber\"=%s;"
-            cursor.execute(delete_query, (order_number,))
-        except Error as e:
-            print(f"Error deleting order {order_number} from {source_table}: {e}")
-
-    
-    def column_update(cursor, order_number, update_values):
-        try:
-            set_clause = ", ".join([f"\"{column}\"=%s" for column in update_values.keys()])
-            update_query = f"UPDATE shipments SET {set_clause} WHERE \"OrderNumber\"=%s;"
-            cursor.execute(update_query, (*update_values.values(), order_number))
-        except (Error, ProgrammingError, OperationalError) as e:
-            print(f"Database error occurred while updating columns: {e}")
-
-    def fetch_column_value(cursor, order_number, *columns):
-        column_names = ", ".join([f"\"{column}\"" for column in columns])
-        try:
-            fetch_query = f"SELECT {column_names} FROM shipments WHERE \"OrderNumber\"=%s;"
-            cursor.execute(fetch_query, (order_number,))
-            result = cursor.fetchone()
-            if result is not None:
-                if len(result) == 1:
-                    return result[0]
-                else:
-                    return result
-        except (Error, ProgrammingError, OperationalError) as e:
-            print(f"Database error occurred while fetching column values: {e}")
-        return None
-
     def add_to_email(order_data_dict, status_entry, row):
         # Structure of the data to be added
         data_to_add = {
@@ -164,35 +121,106 @@ def lambda_handler(event, context):
         }
         # Add data to the appropriate order data dictionary
         order_data_dict.setdefault(status_entry, []).append(data_to_add)
+        return data_to_add
+
+    order_data = {
+        classification.STUCK: stuck_order_data,
+        classification.PROBLEM: problem_order_data,
+        classification.DELAY: delay_order_data,
+        classification.ALERT: alert_order_data,
+    }
+
+    def process_shipment(row, status):
+        # Apply the delivered/problem/delay/alert rules to one shipment given its parsed carrier response
+        nonlocal problem_orders, delivered, alerts
+        writes.record_poll(row['OrderNumber'], polling_schedule.poll_state(row, status, current_date))
+        if history is not None:
+            history.record(row['TrackingNumber'], status)
+
+        state = {**dict(row), **writes.pending(row['OrderNumber'])}
+        with metrics.timer('classification'):
+            actions = classification.classify(state, status, current_date)
+        for action in actions:
+            kind = action[0]
+            if kind == "update":
+                writes.update(row['OrderNumber'], action[1])
+            elif kind == "move":
+                writes.move(row['OrderNumber'], action[1], action[2])
+                if action[1] == "delivered":
+                    delivered += 1
+            elif kind == "email":
+                category, status_entry = action[1], action[2]
+                order = add_to_email(order_data[category], status_entry, row)
+                if notifications.customer_notifications:
+                    notifier.add(category, status_entry, order)
+                if category == classification.ALERT:
+                    alerts += 1
+                else:
+                    problem_orders += 1
+            else:
+                print(action[1])
+
+    def send_report(subject_line):
+        counts = {'processed': total_shipments, 'delivered': delivered, 'problem_orders': problem_orders, 'errors': errors, 'alerts': alerts}
+        with metrics.timer('report_render'):
+            report_content = report.render_report(counts, stuck_order_data, problem_order_data, delay_order_data, alert_order_data, error_orders)
+            # The inline tables are capped, so the full list always goes out as a CSV attachment
+            attachment = report.csv_attachment(order_data, error_orders)
+
+        from sendgrid.helpers.mail import Mail
+
+        report_email = Mail(
+            from_email= config.from_email,
+            to_emails= config.to_emails,
+            subject=subject_line,
+            html_content=report_content
+        )
+        if attachment is not None:
+            report_email.add_attachment(attachment)
+
+        try:
+            with metrics.timer('sendgrid_send'):
+                response = sendgrid().send(report_email)
+            print("Execution report email sent successfully.")
+        except Exception as e:
+            print(f"Error sending execution report email: {e}")
+
+    def notify_customers():
+        if len(notifier):
+            sent, already_sent, failed = notifier.dispatch()
+            print(f"Customer notifications: {sent} sent, {already_sent} already sent, {failed} failed")
+
+    def run_counts():
+        return {
+            'shipments': total_shipments,
+            'polled': processed_shipments,
+            'skipped': skipped_shipments,
+            'delivered': delivered,
+            'problem_orders': problem_orders,
+            'alerts': alerts,
+            'tracking_errors': errors,
+        }
+
+    # Run time is taken per invocation; a warm container's module state may be hours old
+    current_date = datetime.datetime.now(tz_us_pacific)
 
-    def generate_order_rows(code, orders, bg_color, stuck=False):
-        if 'Pre' not in code:
-            if stuck:
-                code = code[5:]
-            elif code[:3] == '003':
-                code = "Status Stuck at 'Shipment Ready for UPS'"
-
-        order_rows = f"""
-            <tr style="background-color: {bg_color};">
-                <td rowspan="{len(orders)}" style="width: 20%; border: 1px solid black; padding: 5px;"><b>{code}</b></td>
-                <td style="border: 1px solid black; padding: 5px;">{orders[0]['order_number']}</td>
-                <td style="border: 1px solid black; padding: 5px;">{orders[0]['tracking_number']}</td>
-                <td style="border: 1px solid black; padding: 5px;">{orders[0]['shipped_date']}</td>
-                <td style="border: 1px solid black; padding: 5px;">{orders[0]['customer_name']}</td>
-                <td style="border: 1px solid black; padding: 5px;">{orders[0]['customer_email']}</td>
-            </tr>
-        """
-        for order in orders[1:]:
-            order_rows += f"""
-                <tr style="background-color: {bg_color};">
-                    <td style="border: 1px solid black; padding: 5px;">{order['order_number']}</td>
-                    <td style="border: 1px solid black; padding: 5px;">{order['tracking_number']}</td>
-                    <td style="border: 1px solid black; padding: 5px;">{order['shipped_date']}</td>
-                    <td style="border: 1px solid black; padding: 5px;">{order['customer_name']}</td>
-                    <td style="border: 1px solid black; padding: 5px;">{order['customer_email']}</td>
-                </tr>
-            """
-        return order_rows
+    # Determine whether it's morning or afternoon
+    if current_date.hour < 12:
+        time_of_day = "Morning"
+    else:
+        time_of_day = "Afternoon"
+
+    # Updates, table moves and new tracking events are buffered and written in bulk
+    history = event_history.EventHistory() if event_history.event_history else None
+    writes = shipment_store.WriteBuffer(cursor, history=history)
+
+    # Customer emails for flagged orders go out after the run's writes are committed
+    notifier = notifications.NotificationDispatcher(cnx, sendgrid)
+
+    if migrations.auto_migrate:
+        migrations.migrate(cnx)
+    if history is not None:
+        event_history.ensure_partitions(cursor, current_date)
 
     if 'body' in event:
         event_body = json.loads(event['body'])
@@ -207,379 +235,253 @@ def lambda_handler(event, context):
                 num_new_entries = len(database_entries)
 
                 print(f"Adding {num_new_entries} shipments from new shipment batch to database")
-                print(f"Full batch for reference: {database_entries}")
-
-                counter = 0
-                for entry in database_entries:
-                    counter += 1
-                    print(f"Processing order {counter} of {num_new_entries}")
-
-                    sql = '''
-                        INSERT INTO "shipments" (
-                            "OrderNumber", "CustomerName", "CustomerEmail", "TrackingNumber", "CarrierName", "ShippedDate", "StatusCode", "LastLocation", 
-                            "DaysAtLastLocation", "NotificationSent", "Delayed", "Delivered",
-                            "STK", "A1GG", "A1LLF", "GreenGlow", "IronStrength", "LiquidLush", "MightyMicros", 
-                            "SoilBalance", "TurfTonic", "MosquitoDefense", "LawnGuard", "LoneStarLawnFood", 
-                            "WeedWizardBottle", "Sprayer", "LawnGuardSprayer", "WandSprayer"
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                        ON CONFLICT ("OrderNumber") DO UPDATE 
-                        SET 
-                            "CustomerName" = EXCLUDED."CustomerName",
-                            "CustomerEmail" = EXCLUDED."CustomerEmail",
-                            "TrackingNumber" = EXCLUDED."TrackingNumber",
-                            "CarrierName" = EXCLUDED."CarrierName",
-                            "ShippedDate" = EXCLUDED."ShippedDate",
-                            "StatusCode" = EXCLUDED."StatusCode",
-                            "LastLocation" = EXCLUDED."LastLocation",
-                            "DaysAtLastLocation" = EXCLUDED."DaysAtLastLocation",
-                            "NotificationSent" = EXCLUDED."NotificationSent",
-                            "Delayed" = EXCLUDED."Delayed",
-                            "Delivered" = EXCLUDED."Delivered",
-                            "STK" = EXCLUDED."STK",
-                            "A1GG" = EXCLUDED."A1GG",
-                            "A1LLF" = EXCLUDED."A1LLF",
-                            "GreenGlow" = EXCLUDED."GreenGlow",
-                            "IronStrength" = EXCLUDED."IronStrength",
-                            "LiquidLush" = EXCLUDED."LiquidLush",
-                            "MightyMicros" = EXCLUDED."MightyMicros",
-                            "SoilBalance" = EXCLUDED."SoilBalance",
-                            "TurfTonic" = EXCLUDED."TurfTonic",
-                            "MosquitoDefense" = EXCLUDED."MosquitoDefense",
-                            "LawnGuard" = EXCLUDED."LawnGuard",
-                            "LoneStarLawnFood" = EXCLUDED."LoneStarLawnFood",
-                            "WeedWizardBottle" = EXCLUDED."WeedWizardBottle",
-                            "Sprayer" = EXCLUDED."Sprayer",
-                            "LawnGuardSprayer" = EXCLUDED."LawnGuardSprayer",
-                            "WandSprayer" = EXCLUDED."WandSprayer"
-                        WHERE "shipments"."TrackingNumber" != EXCLUDED."TrackingNumber";
-                    '''
-
-                    data = (
-                        entry['OrderNumber'], entry['CustomerName'], entry['CustomerEmail'], entry['TrackingNumber'], entry['CarrierName'], entry['ShippedDate'],
-                        entry['StatusCode'], entry['LastLocation'], entry['DaysAtLastLocation'], entry['NotificationSent'], entry['Delayed'], entry['Delivered'],
-                        entry.get('STK', 0), entry.get('A1GG', 0), entry.get('A1LLF', 0), entry.get('GreenGlow', 0), entry.get('IronStrength', 0), entry.get('LiquidLush', 0),
-                        entry.get('MightyMicros', 0), entry.get('SoilBalance', 0), entry.get('TurfTonic', 0), entry.get('MosquitoDefense', 0), entry.get('LawnGuard', 0),
-                        entry.get('LoneStarLawnFood', 0), entry.get('WeedWizardBottle', 0), entry.get('Sprayer', 0), entry.get('LawnGuardSprayer', 0), entry.get('WandSprayer', 0)
-                    )
-
-                    try:
-                        cursor.execute(sql, data)
-                    except Error as e:
-                        print(f"Error inserting or updating order #{entry['OrderNumber']} into shipments table: {e}")
-                        cnx.commit()  # Commit the successful transactions before the rollback
-                        cnx.rollback()  # Rollback the transaction
-                        continue
-                            
-                cnx.commit()
-
-        return
-
-    current_date = datetime.datetime.now(tz_us_pacific)
-
-    usps_auth_token = get_usps_access_token()
-
-    ups_auth_token = get_ups_token()
 
-    for row in cursor.fetchall():
-        processed_shipments += 1
-        print(f"Processing shipment {processed_shipments} out of {total_shipments}")
-        if row["ShippedDate"] == current_date.date():
-            continue
-        try:
-            tracking_number = row['TrackingNumber']
-            carrier_name = row['CarrierName']
-            try:
-                if carrier_name == 'USPS':
-                    # Handle USPS tracking
-                    url = f'https://api.usps.com/tracking/v3/tracking/{tracking_number}?expand=DETAIL'
-                    headers = {
-                        'Authorization': 'Bearer ' + usps_auth_token
-                    }
-                    response = requests.get(url, headers=headers)
-                    details = response.json()
-
-                    # current_location = details['trackingEvents'][0]['eventCity']
-
-                    # if row["LastLocation"] == current_location:
-                    #     days_at_last_location = calculate_days(row["ShippedDate"], current_date)
-
-                    #     if days_at_last_location >= 3 and :
-                    #         problem_orders += 1
-                    #         move_row(cursor, row['OrderNumber'], "shipments", "problem_orders", True)
-                    #         add_to_email(problem_order_data, "Status Stuck at 'Pre-Shipment' for 3 or More Business Days", row)
-                        
-                    #     # Update DaysAtLastLocation with the calculated days
-                    #     column_update(cursor, row['OrderNumber'], {"DaysAtLastLocation": days_since_shipped})
-
-                    if details.get('trackingEvents'):
-                        if isinstance(details['trackingEvents'], list):
-                            last_location = details['trackingEvents'][0]['eventCity']
-                        elif isinstance(details['trackingEvents'], dict):
-                            last_location = details['trackingEvents'].get('eventCity', 'Unknown')
-                        else:
-                            print(f"Unexpected type or value for trackingEvents: {type(details.get('trackingEvents'))}, {details.get('trackingEvents')}")
-                            continue
-
-                        column_update(cursor, row['OrderNumber'], {"StatusCode": details['statusCategory'], "LastLocation": last_location})
-                    else:
-                        print(f"TrackingEvents key not found in details.")
-                        continue
-
-
-                    if 'Delivered' in details['statusCategory']:
-                        delivered += 1
-                        column_update(cursor, row['OrderNumber'], {"Delivered": 'Yes'})
-                        move_row(cursor, row['OrderNumber'], "shipments", "delivered")
-                    elif details['statusCategory'] == 'Pre-Shipment' and details['statusCategory'] == row["StatusCode"]:
-                        # Calculate days since the ShippedDate
-                        days_since_shipped = calculate_days(row["ShippedDate"], current_date)
-
-                        if days_since_shipped >= 3:
-                            problem_orders += 1
-                            move_row(cursor, row['OrderNumber'], "shipments", "problem_orders", True)
-                            add_to_email(stuck_order_data, "Status Stuck at 'Pre-Shipment' for 3 or More Business Days", row)
-                        
-                        # Update DaysAtLastLocation with the calculated days
-                        column_update(cursor, row['OrderNumber'], {"DaysAtLastLocation": days_since_shipped})
-
-                    elif details['statusCategory'] == 'Alert':
-                        if details['status'] in config.problem_codes_usps:
-                            problem_orders += 1
-                            move_row(cursor, row['OrderNumber'], "shipments", "problem_orders", True)
-                            add_to_email(problem_order_data, details['status'], row)
-                        else:
-                            if row['NotificationSent'] == 'No':
-                                alerts += 1
-                                column_update(cursor, row['OrderNumber'], {"NotificationSent": 'Yes'})
-                                add_to_email(alert_order_data, details['status'], row)
-                    continue
-
-                elif carrier_name == 'UPS':
-                    response = requests.get(
-                        "https://onlinetools.ups.com/api/track/v1/details/" + tracking_number,
-                        headers={
-                            "Content-Type": "application/json",
-                            "transId": config.trans_id,
-                            "transactionSrc": config.transaction_src,
-                            "Authorization": "Bearer " + ups_auth_token,
-                        },
-                        params={
-                            "locale": "en_US",
-                            "returnSignature": "false"
-                        }
-                    )
-                else:
+                failures = shipment_store.upsert_shipments(cnx, database_entries)
+                for order_number, error in failures:
+                    print(f"Error inserting or updating order #{order_number} into shipments table: {error}")
+                print(f"Added {num_new_entries - len(failures)} of {num_new_entries} shipments; {len(failures)} failed")
+                metrics.emit(entries=num_new_entries, failed_entries=len(failures))
+
+        elif ("tracking_events" in event_body or carriers.is_ups_track_alert(event_body)) and not carriers.webhook_authorized(event.get('headers')):
+            # Anyone who can reach the endpoint could otherwise mark orders delivered or trigger emails
+            print(f"Rejected pushed tracking events without a valid {carriers.WEBHOOK_CREDENTIAL_HEADER} header")
+            metrics.emit(rejected_events=1)
+
+        elif "tracking_events" in event_body or carriers.is_ups_track_alert(event_body):
+            # Pushed carrier events: apply each one to the shipments on that tracking number only
+            tracking_events = carriers.normalize_tracking_events(event_body)
+            print(f"Received {len(tracking_events)} tracking events")
+
+            events_by_number = {(carrier_name, tracking_number): status for carrier_name, tracking_number, status in tracking_events}
+            tracking_numbers = [tracking_number for carrier_name, tracking_number in events_by_number]
+            for row in shipment_store.fetch_shipments_by_tracking(cursor, tracking_numbers):
+                status = events_by_number.get((row['CarrierName'], row['TrackingNumber']))
+                if status is None:
                     continue
+                total_shipments += 1
+                processed_shipments += 1
+                try:
+                    process_shipment(row, status)
+                except Exception as e:
+                    errors += 1
+                    error_orders.append((row['OrderNumber'], row['CustomerName'], row['TrackingNumber']))
+                    print(f"Exception caught while applying tracking event to order {row['OrderNumber']}: {e}\n{traceback.format_exc()}")
+
+            writes.flush()
+            cnx.commit()
+            print(f"Applied tracking events to {processed_shipments} shipments")
+
+            # Orders flagged between scheduled runs would otherwise never reach a report
+            if stuck_order_data or problem_order_data or delay_order_data or alert_order_data or error_orders:
+                send_report(f"[TRACKING UPDATE] {current_date.strftime('%m-%d-%Y %H:%M')}")
+            notify_customers()
+            metrics.emit(**run_counts())
+
+        release_connection(cnx)
+        return
 
-                details = response.json()
-
-            except json.JSONDecodeError:
-                print(f"Failed to get valid JSON response for tracking number: {tracking_number}")
-
-            if 'trackResponse' not in details:
-                print(f"'trackResponse' missing in details for {tracking_number}.")
-                continue
+    if event.get('maintenance'):
+        # Scheduled retention job, run separately from the tracking passes
+        result = event_history.run_maintenance(cnx, cursor, current_date)
+        release_connection(cnx)
+        metrics.emit(**result)
+        return
 
-            if 'shipment' not in details['trackResponse']:
-                print(f"'shipment' missing in 'trackResponse' for {tracking_number}.")
-                continue
+    shard = event.get('shard')
+    report_subject = shard['report_subject'] if shard else f"[TRACKING REPORT] {current_date.strftime('%m-%d-%Y')} {time_of_day}"
+
+    def aggregates():
+        return {
+            'report_subject': report_subject,
+            'total_shipments': total_shipments,
+            'processed_shipments': processed_shipments,
+            'skipped_shipments': skipped_shipments,
+            'problem_orders': problem_orders,
+            'errors': errors,
+            'delivered': delivered,
+            'alerts': alerts,
+            'error_orders': error_orders,
+            'order_data': order_data,
+        }
 
-            if not details['trackResponse']['shipment']:
-                print(f"'shipment' in 'trackResponse' is empty for {tracking_number}.")
-                continue
+    def restore_aggregates(saved):
+        nonlocal report_subject, total_shipments, processed_shipments, skipped_shipments, problem_orders, errors, delivered, alerts
+        report_subject = saved['report_subject']
+        total_shipments = saved['total_shipments']
+        processed_shipments = saved['processed_shipments']
+        skipped_shipments = saved['skipped_shipments']
+        problem_orders = saved['problem_orders']
+        errors = saved['errors']
+        delivered = saved['delivered']
+        alerts = saved['alerts']
+        error_orders[:] = [tuple(error_order) for error_order in saved['error_orders']]
+        for category, orders_by_code in order_data.items():
+            orders_by_code.clear()
+            orders_by_code.update(saved['order_data'].get(category, {}))
+
+    if shard is None:
+        # Runs that stopped too long ago to resume still report the orders they flagged
+        fresh = {**aggregates(), 'error_orders': [], 'order_data': {}}
+        for subject, saved in checkpoints.expired_runs(cursor, current_date):
+            restore_aggregates(saved)
+            send_report(subject)
+        restore_aggregates(fresh)
+        cnx.commit()
+
+    if shard is None and sharding.shard_count > 1:
+        # Coordinator: register the run and fan out one worker invocation per shard. The last
+        # worker to finish sends the report; runs that lost a worker are reported on here.
+        for subject, merged in sharding.overdue_runs(cursor, current_date):
+            # Shards that never checkpointed count as zero; the new run keeps its own subject
+            restore_aggregates({**aggregates(), **merged, 'report_subject': report_subject})
+            send_report(subject)
+        cnx.commit()
+        worker_events = sharding.start_run(cursor, current_date, report_subject)
+        cnx.commit()
+        # Local workers are forked from this process and must not inherit its connection
+        discard_connection()
+        print(f"Starting sharded run {worker_events[0]['shard']['run_id']} with {len(worker_events)} workers")
+        sharding.invoke_workers(worker_events, context)
+        return
 
-            if 'package' not in details['trackResponse']['shipment'][0]:
-                print(f"'package' missing in 'shipment' for {tracking_number}.")
+    # A run that stopped short of the end of the scan is resumed rather than restarted
+    if shard is None:
+        checkpoint = checkpoints.Checkpoint.open(cursor, current_date)
+    else:
+        if not sharding.lock_shard(cursor, shard):
+            print(f"Shard {shard['index']} of run {shard['run_id']} is being worked by another invocation")
+            release_connection(cnx)
+            return
+        checkpoint = checkpoints.Checkpoint.open_shard(cursor, current_date, sharding.shard_run_id(shard), shard['run_id'])
+        if checkpoint.completed:
+            print(f"Shard {shard['index']} of run {shard['run_id']} has already finished")
+            sharding.unlock_shard(cursor, shard)
+            release_connection(cnx)
+            return
+    progress = checkpoint.progress
+    if checkpoint.resumed:
+        restore_aggregates(checkpoint.aggregates)
+        print(f"Resuming run {checkpoint.run_id} after order {progress.last_order_number}")
+
+    def save_checkpoint(completed=False):
+        # Flushed writes and the checkpoint describing them are committed together
+        writes.flush()
+        checkpoint.save(cursor, aggregates(), completed)
+        cnx.commit()
+
+    def shipments_to_track(rows):
+        # Skip rows whose tracking can't have changed since they were last polled. Every shipment
+        # is counted for the report once it is finished with, so rows still in flight when an
+        # invocation stops are only counted after resuming.
+        nonlocal total_shipments, skipped_shipments
+        for row in rows:
+            order_number = row['OrderNumber']
+            progress.scanned(order_number)
+            if progress.already_processed(order_number):
+                progress.finished(order_number)
                 continue
-
-            if not details['trackResponse']['shipment'][0]['package']:
-                print(f"'package' in 'shipment' is empty for {tracking_number}.")
+            if row["ShippedDate"] == current_date.date() or row['CarrierName'] not in carriers.adapters:
+                total_shipments += 1
+                progress.finished(order_number)
                 continue
-
-            if 'activity' not in details['trackResponse']['shipment'][0]['package'][0]:
-                print(f"'activity' missing in 'package' for {tracking_number}.")
+            if not polling_schedule.is_due(row, current_date):
+                total_shipments += 1
+                skipped_shipments += 1
+                progress.finished(order_number)
                 continue
+            yield row
+
+    def track(rows):
+        # Fetch tracking for the rows and process each result, committing progress every write
+        # batch. Returns True if the invocation ran out of time before finishing the rows.
+        nonlocal total_shipments, processed_shipments, errors
+        scan = shipments_to_track(rows)
+        # Carrier tokens are cached across warm invocations and refreshed by carriers.token_manager
+        tracked = carriers.fetch_tracking_details(scan)
+        try:
+            for row, status, fetch_error in tracked:
+                total_shipments += 1
+                processed_shipments += 1
+                debug(f"Processing shipment {processed_shipments}")
+                try:
+                    tracking_number = row['TrackingNumber']
+                    if isinstance(fetch_error, NoTrackingData):
+                        # Nothing to act on yet; the shipment is polled again next run
+                        print(f"No tracking data for {tracking_number}: {fetch_error}")
+                    elif isinstance(fetch_error, carriers.AuthenticationError):
+                        # Logged once when the token fetch failed, and shared by every row for the
+                        # carrier, so it isn't re-raised with a traceback per row
+                        errors += 1
+                        error_orders.append((row['OrderNumber'], row['CustomerName'], row['TrackingNumber']))
+                    elif fetch_error is not None:
+                        if isinstance(fetch_error, json.JSONDecodeError):
+                            print(f"Failed to get valid JSON response for tracking number: {tracking_number}")
+                        raise fetch_error
+                    else:
+                        process_shipment(row, status)
+
+                except Exception as e:
+                    errors += 1
+                    error_orders.append((row['OrderNumber'], row['CustomerName'], row['TrackingNumber']))
+                    print(f"Exception caught by master try-except block for order {row['OrderNumber']}: {e}\n{traceback.format_exc()}")
+                finally:
+                    progress.finished(row['OrderNumber'])
+
+                # Commit progress every write batch, and stop while there is still time to do so.
+                # Shard workers only commit between pages, as a commit releases the page's row locks.
+                time_left = checkpoints.time_left(context)
+                out_of_time = time_left is not None and time_left < checkpoints.checkpoint_reserve_seconds
+                if out_of_time or (shard is None and len(writes) >= shipment_store.write_batch_size):
+                    save_checkpoint()
+                    notify_customers()
+                if out_of_time:
+                    return True
+            return False
+        finally:
+            # Stops the carrier workers and releases the scan cursor if the loop ended early
+            tracked.close()
+            scan.close()
+
+    if shard is None:
+        out_of_time = track(shipment_store.stream_shipments(cnx, progress.last_order_number))
+    else:
+        # Shard workers claim their rows a page at a time; committing a page with its checkpoint
+        # releases the row locks
+        shard_condition, shard_params = sharding.shard_filter(shard)
+        out_of_time = False
+        while not out_of_time:
+            page = shipment_store.claim_shipments(cursor, progress.last_order_number, shard_condition, shard_params, sharding.shard_page_size)
+            if not page:
+                break
+            out_of_time = track(page)
+            if not out_of_time:
+                save_checkpoint()
+                notify_customers()
+
+    if out_of_time:
+        print(f"Out of time after {processed_shipments} shipments; run {checkpoint.run_id} will resume after order {progress.last_order_number}")
+        # Hand the rest of the scan (or shard) to a fresh invocation, which resumes from the checkpoint
+        discard_connection()
+        sharding.invoke_workers([event], context)
+        metrics.emit(**run_counts(), completed=False)
+        return
 
-            package_details = details['trackResponse']['shipment'][0]['package'][0]
-            activity = package_details['activity'][0]
-            status_code = package_details['currentStatus']['code']
-            status_code_desc = package_details['currentStatus']['description']
-            new_status_entry = f"{status_code}: {status_code_desc}"
-            is_delivered = status_code in config.delivered_codes
-            is_problem_code = status_code in config.problem_codes_ups
-            is_delayed = status_code in config.delay_codes
-
-            # Update the StatusCode in the database
-            column_update(cursor, row['OrderNumber'], {"StatusCode": new_status_entry})
-
-            # Check for '003' status code and days since shipment
-            if status_code == '003' and calculate_days(row['ShippedDate'], current_date) >= 3:
-                is_problem_code = True
-
-            # Process current location
-            try:
-                current_location = activity['location']['address']['city']
-                result = fetch_column_value(cursor, row['OrderNumber'], "LastLocation", "LastLocationDate")
-                if result is not None:
-                    previous_location, previous_location_date = result
-                    # Check if LastLocation exists
-                    if previous_location:
-                        if current_location != previous_location:
-                            # Update LastLocation, set LastLocationDate to activity date and DaysAtLastLocation to the difference between activity date and current date
-                            days_at_location = calculate_days(activity['date'], current_date)
-                            column_update(cursor, row['OrderNumber'], {"LastLocation": current_location, "LastLocationDate": activity['date'], "DaysAtLastLocation": days_at_location})
-                        else:
-                            # Calculate days at current location
-                            if previous_location_date is not None:
-                                days_at_location = calculate_days(previous_location_date, current_date)
-                                column_update(cursor, row['OrderNumber'], {"DaysAtLastLocation": days_at_location})
-
-                                # If shipment hasn't moved, only address it if it has no estimated delivery date
-                                if days_at_location >= 3 and not package_details['deliveryDate']:
-                                    notification_status = fetch_column_value(cursor, row['OrderNumber'], "NotificationSent")
-                                    if days_at_location >= 5 and notification_status == 'No':
-                                        problem_orders += 1
-                                        add_to_email(stuck_order_data, '999: 5 Business Days without a Location Update, and No Delivery Date Found', row)
-                                        move_row(cursor, row['OrderNumber'], "shipments", "problem_orders", True)
-
-                                    elif days_at_location == 3:
-                                        if notification_status == 'No':
-                                            problem_orders += 1
-                                            add_to_email(stuck_order_data, '998: 3 Business Days without a Location Update, and No Delivery Date Found', row)
-                                            column_update(cursor, row['OrderNumber'], {"NotificationSent": 'Yes'})
-                                        else:
-                                            column_update(cursor, row['OrderNumber'], {"NotificationSent": 'No'})
-
-                            else:
-                                # If LastLocationDate is None, set it to the current date and DaysAtLastLocation to 0
-                                column_update(cursor, row['OrderNumber'], {"LastLocationDate": current_date, "DaysAtLastLocation": 0})
-
-                else:
-                    print(f"No record found for order: {row['OrderNumber']}")
-                    continue
-            except Exception as e:
-                print(f"Error processing order {row['OrderNumber']}: {e}")
-            if is_delivered:
-                delivered += 1
-                column_update(cursor, row['OrderNumber'], {"Delivered": 'Yes'})
-                move_row(cursor, row['OrderNumber'], "shipments", "delivered")
-
-            elif is_problem_code:
-                if is_delayed:
-                    # Fetch the current state of the Delayed column
-                    delayed_status = fetch_column_value(cursor, row['OrderNumber'], "Delayed")
-                    # If the order is already marked as delayed, skip this iteration
-                    if delayed_status == 'No':
-                        problem_orders += 1
-                        add_to_email(delay_order_data, new_status_entry, row)
-                        column_update(cursor, row['OrderNumber'], {"Delayed": 'Yes'})
-                else:
-                    problem_orders += 1
-                    add_to_email(problem_order_data, new_status_entry, row)
-                    move_row(cursor, row['OrderNumber'], "shipments", "problem_orders", True)
-
-
-        except Exception as e:
-            errors += 1
-            error_orders.append((row['OrderNumber'], row['CustomerName'], row['TrackingNumber']))
-            print(f"Exception caught by master try-except block for order {row['OrderNumber']}: {e}\n{traceback.format_exc()}")
-            continue
-
-    report_content = f"""\
-    <br><u><b>Processing Counts</b></u><br>
-    # of Orders Processed: {total_shipments}<br>
-    # of Orders Delivered: {delivered}<br>
-    # of Problem Orders: {problem_orders}<br>
-    # of Orders with Tracking Errors: {errors}<br>
-    # of Alerts: {alerts}<br><br>
-    <table style="width: 100%; border: 1px solid black;">
-        <tr><th colspan="6" style="font-size:18px;">Problem Orders</th></tr>
-        <tr>
-            <th style="border: 1px solid black; padding: 5px;">Problem Code</th>
-            <th style="border: 1px solid black; padding: 5px;">Order Number</th>
-            <th style="border: 1px solid black; padding: 5px;">Tracking Number</th>
-            <th style="border: 1px solid black; padding: 5px;">Ship Date</th>
-            <th style="border: 1px solid black; padding: 5px;">Customer Name</th>
-            <th style="border: 1px solid black; padding: 5px;">Customer Email</th>
-        </tr>
-    """
-
-    # Handle stuck orders first
-    for code, orders in stuck_order_data.items():
-        if code[4] == ':':  # Check if the 4th character is a colon
-            color_key = code[:3]  # Extract the three numbers
-        else:
-            color_key = code  # Use the entire order code
-
-        bg_color = config.email_color_codes.get(color_key, "#ffffff")
-        report_content += generate_order_rows(code, orders, bg_color, True)
-
-    # Handle non-delayed problem orders
-    for code, orders in problem_order_data.items():
-        if code[4] == ':':  # Check if the 4th character is a colon
-            color_key = code[:3]  # Extract the three numbers
-        else:
-            color_key = code  # Use the entire order code
-
-        bg_color = config.email_color_codes.get(color_key, "#ffffff")
-        report_content += generate_order_rows(code, orders, bg_color)
-
-
-    # Handle delayed problem orders
-    for code, orders in delay_order_data.items():
-        color_key = code[:3]
-        bg_color = config.email_color_codes.get(color_key, "#ffffff")
-        report_content += generate_order_rows(code, orders, bg_color)
-
-    report_content += "</table>"
-
-    if alerts > 0:
-        report_content += f"""
-        <br><br><table style="width: 100%; border: 1px solid black;">
-            <tr><th colspan="6" style="font-size:18px;">Alert Orders</th></tr>
-            <tr>
-                <th style="border: 1px solid black; padding: 5px;">Alert Code</th>
-                <th style="border: 1px solid black; padding: 5px;">Order Number</th>
-                <th style="border: 1px solid black; padding: 5px;">Tracking Number</th>
-                <th style="border: 1px solid black; padding: 5px;">Ship Date</th>
-                <th style="border: 1px solid black; padding: 5px;">Customer Name</th>
-                <th style="border: 1px solid black; padding: 5px;">Customer Email</th>
-            </tr>
-        """
-
-        # Handle alert orders
-        for code, orders in alert_order_data.items():
-            color_key = code
-            bg_color = config.email_color_codes.get(color_key, "#ffffff")
-            report_content += generate_order_rows(code, orders, bg_color)
-
-        report_content += "</table>"
-
-
-
-    if error_orders:
-        report_content += "<br><br><u><b>Received error message when trying to track the following order(s):</b></u><br><ul>"
-        for order_number, customer, tracking in error_orders:
-            report_content += f"<li>#{order_number} {customer}: {tracking}</li>"
-        report_content += "</ul>"
-
-    subject_line = f"[TRACKING REPORT] {now.strftime('%m-%d-%Y')} {time_of_day}"
-    report_email = Mail(
-        from_email= config.from_email,
-        to_emails= config.to_emails,
-        subject=subject_line,
-        html_content=report_content
-    )
-
-    print(f"Stuck shipments: {stuck_order_data}")
-    print(f"Problem shipments: {problem_order_data}")
-    print(f"Delay shipments: {delay_order_data}")
-    print(f"Alert shipments: {alert_order_data}")
-
-    try:
-        response = sg.send(report_email)
-        print("Execution report email sent successfully.")
-    except Exception as e:
-        print(f"Error sending execution report email: {e}")
-    cnx.commit()
-    cnx.close()
\ No newline at end of file
+    print(f"Polled {processed_shipments} shipments; {skipped_shipments} were not due for a poll")
+    counts = run_counts()
+
+    if shard is None:
+        send_report(report_subject)
+        save_checkpoint(completed=True)
+    else:
+        save_checkpoint(completed=True)
+        merged = sharding.finish_shard(cursor, shard)
+        if merged is not None:
+            # Last worker of the run: report on every shard's results
+            restore_aggregates(merged)
+            send_report(report_subject)
+        cnx.commit()
+    notify_customers()
+    if shard is not None:
+        sharding.unlock_shard(cursor, shard)
+    release_connection(cnx)
+    metrics.emit(**counts)
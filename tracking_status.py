@@ -0,0 +1,137 @@
+import json
+from typing import NamedTuple
+
+import config
+
+
+# 'auto' decodes carrier responses with orjson when it is installed, 'json' always uses the
+# standard library. orjson is optional and only imported on the first decode.
+json_backend = getattr(config, 'json_backend', 'auto')
+decoder = None
+
+
+def loads(data):
+    global decoder
+    if decoder is None:
+        decoder = json.loads
+        if json_backend != 'json':
+            try:
+                import orjson
+                decoder = orjson.loads
+            except ImportError:
+                pass
+    return decoder(data)
+
+
+class ResponseError(ValueError):
+    # A carrier response the tracking rules can't use
+    pass
+
+
+class NoTrackingData(ResponseError):
+    # The carrier has nothing to report on the shipment yet; it is logged and polled again
+    pass
+
+
+class MalformedResponse(ResponseError):
+    # A response missing fields that every tracking response has; counted as a tracking error
+    pass
+
+
+class TrackingStatus(NamedTuple):
+    # The only fields of a carrier response the tracking pass uses. Parsed once per response,
+    # so the decoded JSON is dropped as soon as it has been read.
+    carrier: str
+    code: str  # UPS status code; None for USPS
+    description: str  # UPS status description, USPS status
+    category: str  # USPS status category, UPS status type
+    city: str  # city of the latest event; None if the event has no location
+    activity_date: str  # UPS activity date as YYYYMMDD; None for USPS
+    event_time: str  # identifies the latest event; None if the carrier gave no time
+    delivery_date: str  # first scheduled or expected delivery date, if any
+
+
+def parse_ups(details):
+    # details is a UPS Track API response
+    try:
+        shipments = details['trackResponse']['shipment']
+    except (KeyError, TypeError):
+        raise NoTrackingData("'trackResponse' or 'shipment' missing in details") from None
+    if not shipments or not shipments[0].get('package'):
+        raise NoTrackingData("No package in 'trackResponse'")
+    package = shipments[0]['package'][0]
+    if 'activity' not in package:
+        raise NoTrackingData("'activity' missing in 'package'")
+    try:
+        activity = package['activity'][0]
+        current_status = package['currentStatus']
+        code = current_status['code']
+        description = current_status['description']
+    except (KeyError, IndexError, TypeError) as e:
+        raise MalformedResponse(f"UPS response missing {e}") from None
+    try:
+        city = activity['location']['address']['city']
+    except (KeyError, TypeError):
+        city = None
+    delivery_dates = package.get('deliveryDate') or []
+    return TrackingStatus(
+        carrier='UPS',
+        code=code,
+        description=description,
+        category=current_status.get('type'),
+        city=city,
+        activity_date=activity.get('date'),
+        event_time=f"{activity.get('date', '')}{activity.get('time', '')}" or None,
+        delivery_date=delivery_dates[0].get('date') if delivery_dates else None,
+    )
+
+
+def parse_usps(details):
+    # details is a USPS Tracking API response, or one element of a batch response
+    events = details.get('trackingEvents')
+    if not events:
+        raise NoTrackingData("TrackingEvents key not found in details.")
+    if isinstance(events, list):
+        event = events[0]
+        if 'eventCity' not in event:
+            raise MalformedResponse("USPS tracking event missing 'eventCity'")
+        city = event['eventCity']
+    elif isinstance(events, dict):
+        event = events
+        city = event.get('eventCity', 'Unknown')
+    else:
+        raise NoTrackingData(f"Unexpected type or value for trackingEvents: {type(events)}, {events}")
+    if 'statusCategory' not in details:
+        raise MalformedResponse("USPS response missing 'statusCategory'")
+    if details['statusCategory'] == 'Alert' and 'status' not in details:
+        raise MalformedResponse("USPS alert response missing 'status'")
+    return TrackingStatus(
+        carrier='USPS',
+        code=None,
+        description=details.get('status'),
+        category=details['statusCategory'],
+        city=city,
+        activity_date=None,
+        event_time=event.get('eventTimestamp'),
+        delivery_date=details.get('expectedDeliveryDate'),
+    )
+
+
+parsers = {
+    'UPS': parse_ups,
+    'USPS': parse_usps,
+}
+
+
+def parse(carrier_name, details):
+    if not isinstance(details, dict):
+        raise MalformedResponse(f"Expected a JSON object from {carrier_name}, got {type(details).__name__}")
+    return parsers[carrier_name](details)
+
+
+def parse_or_error(carrier_name, details):
+    # For batch responses, where one bad element shouldn't fail the others
+    try:
+        return parse(carrier_name, details)
+    except ResponseError as e:
+        return e